@@ -0,0 +1,135 @@
+"""Admission control: per-caller rate limits and a cap on the requests in flight in a worker.
+
+Every caller has a token bucket for reads and one for writes. Authenticated callers are told apart by their
+user id, anonymous ones by their address. A request that finds its bucket empty is answered with 429 right
+away, and a request that arrives while MAX_IN_FLIGHT requests are being handled by the worker with 503, both
+with a Retry-After header, instead of waiting for a connection of the MongoDB pool.
+
+The buckets and the in-flight count are kept per worker, so under gunicorn a caller can make up to the rate
+times the number of workers. Both checks are off unless configured.
+"""
+import collections
+import functools
+import json
+import math
+import threading
+import time
+from flask import g, request
+import metrics
+
+# sent with the 503 of a full worker, by then the requests in flight are usually done
+IN_FLIGHT_RETRY_AFTER = 1
+
+
+class RateLimiter:
+    """Token buckets of `rate` requests per second that hold up to `burst` requests, one bucket per key.
+
+    A rate of 0 lets every request through. Only the `maxKeys` most recently used buckets are kept; the
+    bucket of a key that comes back after being dropped starts full again.
+    """
+
+    def __init__(self, name, rate, burst=None, maxKeys=10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.maxKeys = maxKeys
+        # key -> [tokens, time of the last refill]
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Takes a token from the bucket of `key`. Returns 0 if there was one, or else the seconds until there is."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.maxKeys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+
+class InFlightLimiter:
+    """Counts the requests in flight and refuses new ones above `maxInFlight`. 0 means no cap."""
+
+    def __init__(self, maxInFlight):
+        self.maxInFlight = maxInFlight
+        self.inFlight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.maxInFlight > 0 and self.inFlight >= self.maxInFlight:
+                return False
+            self.inFlight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.inFlight -= 1
+
+
+def callerKey():
+    """Identifies the caller of the current request: the user id once authenticated, or else the address."""
+    auth = g.get("auth")
+    if auth is not None and getattr(auth, "user_id", None):
+        return "user:" + auth.user_id
+    # behind the API gateway, the last X-Forwarded-For entry is the address the gateway got the request from
+    return "address:" + (request.access_route[-1] if request.access_route else str(request.remote_addr))
+
+
+def rateLimited(limiter):
+    """Decorator that answers 429 when the caller is over the rate of `limiter`.
+
+    Must be applied below the security decorators, so that authenticated callers are limited by user id.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            retryAfter = limiter.acquire(callerKey())
+            if retryAfter > 0:
+                metrics.SHED_REQUESTS.labels(limiter.name).inc()
+                errorMessage = {
+                    "msg": "Too many requests, retry in {0:.1f} seconds".format(retryAfter)
+                }
+                return json.dumps(errorMessage), 429, {"Retry-After": str(math.ceil(retryAfter))}
+            metrics.ADMITTED_REQUESTS.labels(limiter.name).inc()
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(app, limiter, exempt=()):
+    """Answers 503 to the requests of a Flask app that arrive while `limiter` is full.
+
+    The paths in `exempt` are always let through. A streamed response counts until the view returns, not
+    until its body is sent.
+    """
+
+    @app.before_request
+    def admit():
+        if request.path in exempt:
+            return None
+        if not limiter.acquire():
+            metrics.SHED_REQUESTS.labels("in_flight").inc()
+            errorMessage = {
+                "msg": "The service is busy, retry in {0} seconds".format(IN_FLIGHT_RETRY_AFTER)
+            }
+            return json.dumps(errorMessage), 503, {"Retry-After": str(IN_FLIGHT_RETRY_AFTER)}
+        metrics.ADMITTED_REQUESTS.labels("in_flight").inc()
+        g.inFlight = True
+        return None
+
+    @app.teardown_request
+    def release(error):
+        if g.pop("inFlight", False):
+            limiter.release()
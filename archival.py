@@ -0,0 +1,114 @@
+"""Archival of completed todos.
+
+Todos completed more than ARCHIVE_AFTER_DAYS days ago (default `30`) are moved from the todo collection to
+the archive collection, so that the collection and the indexes behind GET /todos only hold the todos in use.
+GET /todos lists the archived todos only with `include=archived`. Archived todos can't be read, updated or
+deleted by id, and GET /todos/changes doesn't report them as deleted, so clients that synced them keep them.
+With ARCHIVE_RETENTION_DAYS set, MongoDB deletes archived todos that long after they were archived.
+
+The job runs next to the service, for example as a Kubernetes CronJob:
+
+    python archival.py
+
+It moves ARCHIVE_BATCH_SIZE todos at a time (default `500`) in order of completion. To stay out of the way of
+the requests, it sleeps after every batch so that it works at most ARCHIVE_DUTY_CYCLE of the time (default
+`0.1`), and stops after ARCHIVE_MAX_SECONDS (default `600`); the next run continues where it stopped. The
+report of the run is printed as JSON. Workers may serve moved todos from a local todo cache until the entries
+expire.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+import storage
+from storage import ARCHIVE, TODOS
+
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+ARCHIVE_DUTY_CYCLE = float(os.environ.get("ARCHIVE_DUTY_CYCLE", 0.1))
+ARCHIVE_MAX_SECONDS = float(os.environ.get("ARCHIVE_MAX_SECONDS", 600))
+
+# the order the todos are archived in, backed by the (done, completedAt, _id) index
+ARCHIVE_SORT = [("completedAt", 1), ("_id", 1)]
+
+log = logging.getLogger(__name__)
+
+
+def archiveBatch(store, cutoff, batchSize, after=None, archivedAt=None):
+    """Moves up to `batchSize` todos completed before `cutoff`, starting after the (completedAt, _id) `after`.
+
+    A todo that is updated while it is moved stays in the todo collection. Returns the number of todos moved,
+    of todos left in place and the position to continue from, which is None once no todos are left.
+    """
+    query = {"done": True, "completedAt": {"$lt": cutoff}}
+    if after is not None:
+        completedAt, todoId = after
+        query = {"$and": [query, {"$or": [{"completedAt": {"$gt": completedAt}},
+                                          {"completedAt": completedAt, "_id": {"$gt": todoId}}]}]}
+    todos = list(store.find(TODOS, query, sort=ARCHIVE_SORT, limit=batchSize))
+    if not todos:
+        return 0, 0, None
+
+    todoIds = [todo["_id"] for todo in todos]
+    # copies left behind by an interrupted run are replaced
+    store.deleteMany(ARCHIVE, {"_id": {"$in": todoIds}})
+    archivedAt = archivedAt or datetime.datetime.now()
+    for todo in todos:
+        todo["archivedAt"] = archivedAt
+    writeErrors = store.insert(ARCHIVE, todos)
+    archived = [todo for position, todo in enumerate(todos) if position not in writeErrors]
+
+    # only the versions that were copied are deleted
+    moved = store.deleteMany(TODOS, {
+        "_id": {"$in": [todo["_id"] for todo in archived]},
+        "$or": [{"_id": todo["_id"], "version": todo.get("version")} for todo in archived]
+    }) if archived else 0
+    if moved < len(archived):
+        updated = [todo["_id"] for todo in store.find(TODOS, {"_id": {"$in": todoIds}}, fields=["_id"])]
+        store.deleteMany(ARCHIVE, {"_id": {"$in": updated}})
+
+    last = todos[-1]
+    return moved, len(todos) - moved, (last["completedAt"], last["_id"]) if len(todos) == batchSize else None
+
+
+def run(store, afterDays=ARCHIVE_AFTER_DAYS, batchSize=ARCHIVE_BATCH_SIZE, dutyCycle=ARCHIVE_DUTY_CYCLE,
+        maxSeconds=ARCHIVE_MAX_SECONDS, sleep=time.sleep):
+    """Archives the todos completed more than `afterDays` days ago, in throttled batches. Returns the report."""
+    startedAt = time.monotonic()
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=afterDays)
+    report = {
+        "cutoff": cutoff.isoformat(),
+        "moved": 0,
+        "skipped": 0,
+        "batches": 0,
+        "complete": False
+    }
+    after = None
+    while time.monotonic() - startedAt < maxSeconds:
+        batchStartedAt = time.monotonic()
+        moved, skipped, after = archiveBatch(store, cutoff, batchSize, after)
+        report["moved"] += moved
+        report["skipped"] += skipped
+        report["batches"] += 1
+        log.info("archived %d todos, %d skipped", moved, skipped)
+        if after is None:
+            report["complete"] = True
+            break
+        if dutyCycle < 1:
+            sleep((time.monotonic() - batchStartedAt) * (1 / dutyCycle - 1))
+    report["seconds"] = round(time.monotonic() - startedAt, 3)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    store = storage.createStore()
+    try:
+        print(json.dumps(run(store)))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
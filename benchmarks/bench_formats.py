@@ -0,0 +1,48 @@
+"""Compares the payload size and the server CPU time of the response formats of GET /todos.
+
+Run from the repository root:
+
+    python benchmarks/bench_formats.py
+
+No database is needed. Every format starts from the BSON bytes the driver receives from the server, so the
+figures include decoding them into documents, which the raw BSON passthrough skips. MessagePack is only
+measured when the `msgpack` package is installed.
+"""
+import os
+import sys
+import time
+import timeit
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import serializer
+from bench_serialization import rawTodos
+
+SIZES = [10, 100, 1000]
+RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, timer=time.process_time, number=number, repeat=5)) / number
+    print("  {0:<20} {1:>10} bytes {2:>10.3f} ms".format(label, len(fn()), seconds * 1000))
+
+
+def main():
+    for size in SIZES:
+        wire = b"".join(bson.BSON.encode(todo) for todo in rawTodos(size))
+        number = max(1, 10000 // size)
+
+        print("{0} documents".format(size))
+        bench("json, json_util", lambda: json_util.dumps(bson.decode_all(wire)).encode("utf-8"), number)
+        bench("json, fast", lambda: serializer.listToJson(bson.decode_all(wire)).encode("utf-8"), number)
+        bench("bson, raw", lambda: serializer.listToBson(bson.decode_all(wire, RAW_BSON)), number)
+        if serializer.msgpack is not None:
+            bench("msgpack", lambda: serializer.listToMsgpack(bson.decode_all(wire)), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Compares the throughput of POST /todos with and without GROUP_COMMIT at several concurrency levels.
+
+Run from the repository root:
+
+    python benchmarks/bench_group_commit.py
+
+Every combination runs `bench_load.py` in its own process, as GROUP_COMMIT is read when the service is imported.
+The in-memory store answers inserts without a round trip, so `--insert-latency-ms` (default 1) delays every
+insert to model the round trip to MongoDB. Set DB_BACKEND=mongo to measure against a real server instead, with
+`--insert-latency-ms 0`.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_LOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_load.py")
+CONCURRENCY = [1, 4, 16, 64]
+
+
+def run(groupCommit, concurrency, args):
+    env = dict(os.environ, GROUP_COMMIT="true" if groupCommit else "false")
+    with tempfile.NamedTemporaryFile(suffix=".json") as results:
+        subprocess.run([sys.executable, BENCH_LOAD, "--routes", "create", "--todos", "1000",
+                        "--requests", str(args.requests), "--concurrency", str(concurrency), "--alloc-samples", "0",
+                        "--insert-latency-ms", str(args.insert_latency_ms), "--save", results.name],
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        return json.load(results)["routes"]["create"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests per run (default 1000)")
+    parser.add_argument("--insert-latency-ms", type=float, default=1, help="delay of every insert (default 1)")
+    args = parser.parse_args()
+
+    print("{0:>11} {1:>14} {2:>10} {3:>10} {4:>10}".format("concurrency", "group commit", "req/s", "p50 ms",
+                                                           "p99 ms"))
+    for concurrency in CONCURRENCY:
+        for groupCommit in (False, True):
+            result = run(groupCommit, concurrency, args)
+            print("{0:>11} {1:>14} {2:>10} {3:>10} {4:>10}".format(concurrency, "on" if groupCommit else "off",
+                                                                   result["rps"], result["p50"], result["p99"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+"""Load benchmark of the endpoints of the service, with latency percentiles and regression checks.
+
+Run from the repository root:
+
+    python benchmarks/bench_load.py --todos 10000 --concurrency 4 --save baseline.json
+    python benchmarks/bench_load.py --todos 10000 --concurrency 4 --compare baseline.json
+
+The service is imported in-process with FLASK_ENV=testing and, unless DB_BACKEND is set, the in-memory store,
+so no MongoDB or API gateway is needed. With DB_BACKEND=mongo the todos go into DB_NAME (`todos_bench` by
+default), which is dropped at the end. A fresh RSA key pair is generated into a temporary KEYS_DIR and signs the
+JWT of the benchmark user, so the secured write routes go through the real security chain. The first request
+verifies the token, later ones hit the verified token cache like a client that reuses its token would.
+
+`--server client` drives the app through the Flask test client. `--server wsgi` serves it with the threaded
+werkzeug server on a local port and sends real HTTP requests, which adds the socket and HTTP parsing overhead.
+Every route is called `--requests` times from `--concurrency` threads, after `--warmup` calls that are not
+measured. GET /todos/events is measured up to the first chunk of the stream. The allocations are the peak of the
+memory traced by tracemalloc during a request, taken separately from the timed runs with sequential calls
+through the test client.
+
+`--save` writes the results as a JSON baseline. `--compare` checks them against a baseline and exits with 1 when
+the requests per second of a route dropped, or its p95 latency or allocations grew, by more than `--threshold`,
+or when a route answered more requests with an error status than in the baseline.
+Baselines are only comparable with the same options on the same machine.
+"""
+import argparse
+import collections
+import datetime
+import http.client
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+USER_ID = "5bfbfcab82e62200012c2c45"
+OTHER_USERS = ["5bfbfcab82e62200012c2c{0:02x}".format(i) for i in range(70, 79)]
+SEED_BATCH_SIZE = 10000
+PAGE_SIZE = 50
+LOOKUP_SIZE = 20
+BULK_SIZE = 20
+# routes that are not part of the API of the service
+IGNORED_RULES = ["/static/<path:filename>", "/apidocs/", "/apidocs/index.html", "/apispec_1.json",
+                 "/flasgger_static/<path:filename>"]
+
+
+def generateKeys(keysDir):
+    """Writes a new RSA key pair as `system` and `system.pub` and returns the private key in PEM."""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    privateKey = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                   serialization.NoEncryption())
+    publicKey = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                              serialization.PublicFormat.SubjectPublicKeyInfo)
+    with open(os.path.join(keysDir, "system"), "wb") as keyFile:
+        keyFile.write(privateKey)
+    with open(os.path.join(keysDir, "system.pub"), "wb") as keyFile:
+        keyFile.write(publicKey)
+    return privateKey
+
+
+def signToken(privateKey):
+    import jwt
+
+    now = int(time.time())
+    claims = {
+        "iss": "Microkubes Python example load benchmark",
+        "iat": now,
+        "nbf": 0,
+        "exp": now + 24 * 3600,
+        "sub": USER_ID,
+        "userId": USER_ID,
+        "username": "bench@example.com",
+        "roles": "user,admin",
+        "organizations": "",
+        "scopes": "api:read,api:write",
+    }
+    token = jwt.encode(claims, privateKey, algorithm="RS512")
+    return "Bearer " + (token.decode("ascii") if isinstance(token, bytes) else token)
+
+
+def seedTodos(store, count, createdBy=None):
+    """Inserts `count` todos straight into the store and returns their ids.
+
+    Unless `createdBy` is given, every tenth todo belongs to the benchmark user and the others to other users.
+    """
+    import storage
+
+    createdAt = datetime.datetime(2018, 11, 12, 20, 28, 33)
+    todoIds = []
+    for start in range(0, count, SEED_BATCH_SIZE):
+        todos = []
+        for i in range(start, min(count, start + SEED_BATCH_SIZE)):
+            todo = collections.OrderedDict([
+                ("_id", ObjectId()),
+                ("title", "Title {0}".format(i)),
+                ("description", "Description {0}".format(i)),
+                ("done", i % 3 == 0),
+                ("createdAt", createdAt + datetime.timedelta(seconds=i)),
+            ])
+            if todo["done"]:
+                todo["completedAt"] = createdAt + datetime.timedelta(days=1, seconds=i)
+            todo["createdBy"] = createdBy or (USER_ID if i % 10 == 0 else OTHER_USERS[i % len(OTHER_USERS)])
+            todo["version"] = 1
+            todo["updatedAt"] = todo["createdAt"]
+            todos.append(todo)
+        errors = store.insert(storage.TODOS, todos)
+        if errors:
+            raise RuntimeError("Seeding failed: {0}".format(next(iter(errors.values()))))
+        todoIds.extend(str(todo["_id"]) for todo in todos)
+    return todoIds
+
+
+def delayInserts(store, delay):
+    insert = store.insert
+
+    def delayedInsert(*args, **kwargs):
+        time.sleep(delay)
+        return insert(*args, **kwargs)
+    store.insert = delayedInsert
+
+
+class Scenario:
+    """A route and how to build the requests that call it."""
+
+    def __init__(self, name, rule, method, build, authenticated=False, firstChunkOnly=False, disposable=0):
+        self.name = name
+        self.rule = rule
+        self.method = method
+        self.build = build
+        self.authenticated = authenticated
+        self.firstChunkOnly = firstChunkOnly
+        # number of todos of the benchmark user that every call consumes, created up front
+        self.disposable = disposable
+
+
+def scenarios(fixture):
+    """The scenarios for the seeded todos in `fixture`, at least one for every route of the service."""
+    rng = random.Random(42)
+    seeded = fixture.todoIds
+    owned = fixture.ownedIds
+
+    def take(count):
+        return ",".join(fixture.disposable.popleft() for _ in range(count))
+
+    def bulk():
+        return json.dumps([{"title": "Bulk title", "description": "Bulk description"}] * BULK_SIZE)
+
+    return [
+        Scenario("list", "/todos", "GET", lambda: ("/todos?limit={0}".format(PAGE_SIZE), None)),
+        Scenario("list own, not done", "/todos", "GET",
+                 lambda: ("/todos?limit={0}&done=false".format(PAGE_SIZE), None), authenticated=True),
+        Scenario("list, deep page", "/todos", "GET",
+                 lambda: ("/todos?limit={0}&after={1}".format(PAGE_SIZE, fixture.deepCursor), None)),
+        Scenario("update many", "/todos", "PATCH",
+                 lambda: ("/todos?ids=" + ",".join(rng.sample(owned, 10)), json.dumps({"done": True})),
+                 authenticated=True),
+        Scenario("delete many", "/todos", "DELETE", lambda: ("/todos?ids=" + take(10), None),
+                 authenticated=True, disposable=10),
+        Scenario("create", "/todos", "POST",
+                 lambda: ("/todos", json.dumps({"title": "New title", "description": "New description"})),
+                 authenticated=True),
+        Scenario("create bulk", "/todos/bulk", "POST", lambda: ("/todos/bulk", bulk()), authenticated=True),
+        Scenario("changes", "/todos/changes", "GET", lambda: ("/todos/changes?limit={0}".format(PAGE_SIZE), None)),
+        Scenario("events", "/todos/events", "GET", lambda: ("/todos/events", None), firstChunkOnly=True),
+        Scenario("lookup", "/todos/lookup", "POST",
+                 lambda: ("/todos/lookup", json.dumps({"ids": rng.sample(seeded, LOOKUP_SIZE)}))),
+        Scenario("get", "/todos/<todoId>", "GET", lambda: ("/todos/" + rng.choice(seeded), None)),
+        Scenario("update", "/todos/<todoId>", "PUT",
+                 lambda: ("/todos/" + rng.choice(owned), json.dumps({"title": "Updated title"})),
+                 authenticated=True),
+        Scenario("patch", "/todos/<todoId>", "PATCH",
+                 lambda: ("/todos/" + rng.choice(owned), json.dumps({"done": True})), authenticated=True),
+        Scenario("delete", "/todos/<todoId>", "DELETE", lambda: ("/todos/" + take(1), None),
+                 authenticated=True, disposable=1),
+        Scenario("cache stats", "/cache/stats", "GET", lambda: ("/cache/stats", None)),
+        Scenario("token cache stats", "/cache/tokens/stats", "GET", lambda: ("/cache/tokens/stats", None)),
+        Scenario("metrics", "/metrics", "GET", lambda: ("/metrics", None)),
+        Scenario("profiles", "/profiles", "GET", lambda: ("/profiles", None), authenticated=True),
+        Scenario("profile", "/profiles/<int:profileId>", "GET",
+                 lambda: ("/profiles/{0}".format(fixture.profileId), None), authenticated=True),
+        Scenario("healthz", "/healthz", "GET", lambda: ("/healthz", None)),
+        Scenario("readyz", "/readyz", "GET", lambda: ("/readyz", None)),
+    ]
+
+
+class Fixture:
+    def __init__(self, todoIds):
+        self.todoIds = todoIds
+        self.ownedIds = todoIds[::10]
+        # the cursor of a page in the middle of the todos
+        self.deepCursor = None
+        self.profileId = None
+        self.disposable = collections.deque()
+
+
+class TestClientTransport:
+    """Sends the requests through the Flask test client, one client per thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, path, headers, body, firstChunkOnly=False):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, headers=headers, data=body, buffered=False)
+        try:
+            for _ in response.response:
+                if firstChunkOnly:
+                    break
+        finally:
+            response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class WsgiTransport:
+    """Serves the app with the threaded werkzeug server and sends HTTP requests to it."""
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def send(self, method, path, headers, body, firstChunkOnly=False):
+        # the development server closes the connection after every response
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            if firstChunkOnly:
+                response.readline()
+            else:
+                response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(sortedValues, percent):
+    """Nearest-rank percentile of already sorted values."""
+    if not sortedValues:
+        return None
+    return sortedValues[max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)]
+
+
+def runScenario(transport, scenario, token, requests, concurrency, warmup):
+    headers = {"Content-Type": "application/json"}
+    if scenario.authenticated:
+        headers["Authorization"] = token
+
+    def call():
+        path, body = scenario.build()
+        return transport.send(scenario.method, path, headers, body, scenario.firstChunkOnly)
+
+    for _ in range(warmup):
+        call()
+
+    latencies = []
+    errors = collections.Counter()
+    remaining = itertools.count(requests, -1)
+    lock = threading.Lock()
+
+    def worker():
+        workerLatencies = []
+        workerErrors = collections.Counter()
+        while next(remaining) > 0:
+            startedAt = time.perf_counter()
+            status = call()
+            workerLatencies.append(time.perf_counter() - startedAt)
+            if status >= 400:
+                workerErrors[status] += 1
+        with lock:
+            latencies.extend(workerLatencies)
+            errors.update(workerErrors)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    startedAt = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - startedAt
+
+    latencies.sort()
+    return {
+        "rule": scenario.rule,
+        "method": scenario.method,
+        "requests": len(latencies),
+        "errors": dict((str(status), count) for status, count in errors.items()),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50": round(percentile(latencies, 50) * 1000, 3),
+        "p95": round(percentile(latencies, 95) * 1000, 3),
+        "p99": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def measureAllocations(app, scenario, token, samples):
+    """Median over `samples` sequential requests of the peak memory traced during the request, in KiB."""
+    transport = TestClientTransport(app)
+    headers = {"Content-Type": "application/json"}
+    if scenario.authenticated:
+        headers["Authorization"] = token
+    peaks = []
+    for _ in range(samples):
+        path, body = scenario.build()
+        tracemalloc.start()
+        try:
+            transport.send(scenario.method, path, headers, body, scenario.firstChunkOnly)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    peaks.sort()
+    return round(percentile(peaks, 50) / 1024, 1)
+
+
+def compare(results, baseline, threshold):
+    """Returns the descriptions of the regressions of `results` against `baseline`."""
+    regressions = []
+    for name, result in results["routes"].items():
+        base = baseline["routes"].get(name)
+        if base is None:
+            continue
+        if result["rps"] < base["rps"] * (1 - threshold):
+            regressions.append("{0}: {1} req/s, was {2}".format(name, result["rps"], base["rps"]))
+        if result["p95"] > base["p95"] * (1 + threshold):
+            regressions.append("{0}: p95 {1} ms, was {2}".format(name, result["p95"], base["p95"]))
+        if base.get("allocKiB") and result.get("allocKiB", 0) > base["allocKiB"] * (1 + threshold):
+            regressions.append("{0}: {1} KiB allocated, was {2}".format(name, result["allocKiB"], base["allocKiB"]))
+        # failed requests are not noise: any increase counts, whatever the threshold
+        errors, baseErrors = sum(result["errors"].values()), sum(base.get("errors", {}).values())
+        if errors > baseErrors:
+            regressions.append("{0}: {1} errors {2}, was {3}".format(name, errors, json.dumps(result["errors"]),
+                                                                      baseErrors))
+    return regressions
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--todos", type=int, default=10000, help="number of todos to seed (default 10000)")
+    parser.add_argument("--server", choices=["client", "wsgi"], default="client",
+                        help="drive the app through the Flask test client or a local WSGI server")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of client threads (default 4)")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per route (default 500)")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per route (default 20)")
+    parser.add_argument("--alloc-samples", type=int, default=20,
+                        help="sequential requests per route traced for the allocations, 0 to skip (default 20)")
+    parser.add_argument("--routes", help="only run the scenarios whose name contains this text")
+    parser.add_argument("--insert-latency-ms", type=float, default=0,
+                        help="delay every insert into the store by this much, to model the round trip to MongoDB")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="fail on regressions against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="relative change that counts as a regression (default 0.15)")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    keysDir = tempfile.TemporaryDirectory(prefix="todos-bench-keys-")
+    privateKey = generateKeys(keysDir.name)
+    token = signToken(privateKey)
+
+    # must be set before the service is imported
+    os.environ["KEYS_DIR"] = keysDir.name
+    os.environ.setdefault("FLASK_ENV", "testing")
+    os.environ.setdefault("DB_BACKEND", "memory")
+    os.environ.setdefault("DB_NAME", "todos_bench")
+    import service
+    import db
+    import storage
+
+    if not service.startup.ready.wait(60):
+        sys.exit("The service did not become ready")
+    app = service.app
+    app.testing = True
+
+    try:
+        print("seeding {0} todos".format(args.todos))
+        fixture = Fixture(seedTodos(service.db.store, args.todos))
+        middle = service.db.store.findOne(storage.TODOS, {"_id": ObjectId(fixture.todoIds[args.todos // 2])})
+        fixture.deepCursor = db.encodeCursor(middle)
+        app.test_client().get("/profiles", headers={"Authorization": token, "X-Profile": "true"})
+        fixture.profileId = service.profiles.list()[0]["id"] if service.profiles.list() else 0
+
+        selected = [scenario for scenario in scenarios(fixture) if not args.routes or args.routes in scenario.name]
+        disposable = sum(scenario.disposable * (args.warmup + args.requests + args.alloc_samples)
+                         for scenario in selected)
+        fixture.disposable.extend(seedTodos(service.db.store, disposable, createdBy=USER_ID))
+
+        if args.insert_latency_ms > 0:
+            delayInserts(service.db.store, args.insert_latency_ms / 1000)
+
+        rules = set(rule.rule for rule in app.url_map.iter_rules()) - set(IGNORED_RULES)
+        for rule in sorted(rules - set(scenario.rule for scenario in scenarios(fixture))):
+            print("warning: no scenario for {0}".format(rule))
+
+        transport = TestClientTransport(app) if args.server == "client" else WsgiTransport(app)
+        results = {
+            "options": {
+                "todos": args.todos,
+                "server": args.server,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "backend": os.environ["DB_BACKEND"],
+                "insertLatencyMs": args.insert_latency_ms,
+                "groupCommit": service.db.groupCommit is not None,
+                "python": platform.python_version(),
+            },
+            "routes": collections.OrderedDict(),
+        }
+        print("{0:<20} {1:<7} {2:<26} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} {8:>7}".format(
+            "scenario", "method", "route", "req/s", "p50 ms", "p95 ms", "p99 ms", "alloc KiB", "errors"))
+        try:
+            for scenario in selected:
+                result = runScenario(transport, scenario, token, args.requests, args.concurrency, args.warmup)
+                if args.alloc_samples > 0:
+                    result["allocKiB"] = measureAllocations(app, scenario, token, args.alloc_samples)
+                results["routes"][scenario.name] = result
+                print("{0:<20} {1:<7} {2:<26} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} {8:>7}".format(
+                    scenario.name, scenario.method, scenario.rule, result["rps"], result["p50"], result["p95"],
+                    result["p99"], result.get("allocKiB", "-"), sum(result["errors"].values())))
+        finally:
+            transport.close()
+    finally:
+        service.db.store.drop()
+        keysDir.cleanup()
+
+    if args.save:
+        with open(args.save, "w") as baselineFile:
+            json.dump(results, baselineFile, indent=2)
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline["options"] != results["options"]:
+            print("warning: the baseline was run with {0}".format(baseline["options"]))
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("regression: " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regressions beyond {0:.0%}".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
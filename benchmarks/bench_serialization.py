@@ -0,0 +1,69 @@
+"""Compares the default and the fast (DB_FAST_READS) serialization of todo reads.
+
+Run from the repository root:
+
+    python benchmarks/bench_serialization.py
+
+No database is needed, the documents are generated in memory in the same shape pymongo returns them.
+"""
+import datetime
+import os
+import sys
+import timeit
+from bson import ObjectId, json_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import serializer
+from model import Todo
+
+SIZES = [10, 1000, 10000]
+TODO_FIELDS = [Todo._fields[name].db_field for name in Todo._fields_ordered]
+
+
+def rawTodos(count):
+    createdAt = datetime.datetime(2018, 11, 12, 20, 28, 33, 199000)
+    todos = []
+    for i in range(count):
+        todo = {
+            "_id": ObjectId(),
+            "title": "Title {0}".format(i),
+            "description": "Description {0}".format(i),
+            "done": i % 2 == 0,
+            "createdAt": createdAt + datetime.timedelta(seconds=i),
+            "createdBy": "5bfbfcab82e62200012c2c45",
+            "version": 1,
+            "updatedAt": createdAt + datetime.timedelta(seconds=i),
+        }
+        if todo["done"]:
+            # $set on update appends completedAt after the fields written on create
+            todo["completedAt"] = createdAt + datetime.timedelta(days=1, seconds=i)
+        todos.append(todo)
+    return todos
+
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print("  {0:<28} {1:>12.3f} ms".format(label, seconds * 1000))
+    return seconds
+
+
+def main():
+    for size in SIZES:
+        todos = rawTodos(size)
+        number = max(1, 10000 // size)
+
+        assert serializer.listToJson(todos) == json_util.dumps(todos)
+        for todo in todos:
+            assert serializer.toJson(serializer.reorder(todo, TODO_FIELDS)) == Todo._from_son(todo).to_json()
+
+        print("{0} documents".format(size))
+        listDefault = bench("list, json_util", lambda: json_util.dumps(todos), number)
+        listFast = bench("list, fast", lambda: serializer.listToJson(todos), number)
+        getDefault = bench("get each, Document.to_json", lambda: [Todo._from_son(t).to_json() for t in todos], number)
+        getFast = bench("get each, fast", lambda: [serializer.toJson(serializer.reorder(t, TODO_FIELDS)) for t in todos], number)
+        print("  speedup: list x{0:.1f}, get x{1:.1f}".format(listDefault / listFast, getDefault / getFast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Compiles the OpenAPI spec of the service from the view docstrings.
+
+    python build_apispec.py            # writes apispec.json
+    python build_apispec.py --check    # exits with 1 if apispec.json doesn't match the docstrings
+
+The service serves apispec.json, when it exists and matches the docstrings, in place of the spec Flasgger would
+build on each request.
+"""
+import json
+import os
+import sys
+
+# importing the service must not register on the gateway or connect to the database
+os.environ.setdefault("FLASK_ENV", "testing")
+os.environ["SERVICE_PREFORK"] = "true"
+
+from precompiledspec import SOURCE_DIGEST_FIELD, sourceDigest
+from service import app, swagger, APISPEC_FILE
+
+
+def compileSpec():
+    with app.test_request_context():
+        spec = dict(swagger.get_apispecs("apispec_1"))
+    spec[SOURCE_DIGEST_FIELD] = sourceDigest(app)
+    return (json.dumps(spec, indent=2, sort_keys=True) + "\n").encode("utf-8")
+
+
+def main(args):
+    spec = compileSpec()
+    if "--check" in args:
+        try:
+            with open(APISPEC_FILE, "rb") as specFile:
+                upToDate = specFile.read() == spec
+        except FileNotFoundError:
+            upToDate = False
+        if not upToDate:
+            print("{0} is out of date, run python build_apispec.py".format(APISPEC_FILE))
+            return 1
+        return 0
+
+    with open(APISPEC_FILE, "wb") as specFile:
+        specFile.write(spec)
+    print("Wrote {0}".format(APISPEC_FILE))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
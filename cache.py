@@ -0,0 +1,159 @@
+"""Caches of serialized todos, keyed by todo id.
+
+`DB.getTodoById` reads through the cache, and every write in `DB` refreshes or drops the entries it touches.
+Entries hold the JSON bytes exactly as they are returned to clients, along with their compressed variants.
+A read fills the cache with `fill` rather than `set`, so that a value read before a concurrent write can't
+replace the one the write stored.
+"""
+from collections import OrderedDict
+import os
+import threading
+import time
+
+
+class TodoCache:
+    """Interface for the todo cache backends."""
+
+    def get(self, key):
+        """Returns the cached value or None on a miss."""
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=None):
+        """Stores a value. `ttl` overrides the default time to live of the cache for this entry."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def fillToken(self):
+        """Returns the token to take before reading a value from the database that is then passed to `fill`."""
+        raise NotImplementedError()
+
+    def fill(self, key, value, token):
+        """Stores a value read from the database, unless the cache was written to since `token` was taken."""
+        raise NotImplementedError()
+
+    def stats(self):
+        """Returns a dict with the hit, miss and eviction counters of the cache."""
+        raise NotImplementedError()
+
+
+class NullTodoCache(TodoCache):
+    """Cache that never holds anything. Used when caching is disabled."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def fillToken(self):
+        return None
+
+    def fill(self, key, value, token):
+        pass
+
+    def stats(self):
+        return {"backend": "none"}
+
+
+class LocalTodoCache(TodoCache):
+    """In-process LRU cache with a size bound and a TTL per entry.
+
+    Writes made by other processes are only picked up once the entry expires, so the TTL bounds how stale a
+    read can be when the service runs more than one worker.
+    """
+
+    def __init__(self, maxSize=10000, ttl=30, clock=time.monotonic):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # counts the writes, so that fills can tell whether one happened while they read the database
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiresAt, value = entry
+            if expiresAt <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._writes += 1
+            self._store(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._writes += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            self._entries.clear()
+
+    def fillToken(self):
+        with self._lock:
+            return self._writes
+
+    def fill(self, key, value, token):
+        # any write counts, not only one to this key: a fill that is skipped for nothing only costs a miss
+        with self._lock:
+            if self._writes == token:
+                self._store(key, value, None)
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "size": len(self._entries),
+                "maxSize": self.maxSize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def createCache():
+    """Builds the cache backend configured by the CACHE_BACKEND, CACHE_SIZE and CACHE_TTL env variables."""
+    backend = os.environ.get("CACHE_BACKEND", "local")
+    if backend == "none":
+        return NullTodoCache()
+    if backend == "local":
+        return LocalTodoCache(maxSize=int(os.environ.get("CACHE_SIZE", 10000)),
+                              ttl=float(os.environ.get("CACHE_TTL", 30)))
+    raise ValueError("Unknown cache backend: {0}".format(backend))
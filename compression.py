@@ -0,0 +1,117 @@
+"""Compression of /todos responses.
+
+The encoding is negotiated from Accept-Encoding: zstd and brotli are offered when the `zstandard` and `brotli`
+packages are installed, gzip always. Bodies below COMPRESSION_MIN_SIZE are sent as they are, since compressing
+them costs more than it saves. Streamed responses are compressed on the fly with gzip, flushing after every
+chunk, except for Server-Sent Events that must reach the client as soon as they are written.
+
+A compressed body gets the strong ETag of the identity body with the encoding appended, as in `"<etag>-gzip"`,
+so that each byte stream has a validator of its own. Conditional requests accept the ETag in either form.
+"""
+import gzip
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+
+ENCODERS = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL),
+}
+if brotli is not None:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda body: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+# the encodings we offer, best first
+ENCODINGS = ["zstd", "br", "gzip"]
+PREFERENCE = [encoding for encoding in ENCODINGS if encoding in ENCODERS]
+
+
+def negotiate(acceptEncodings):
+    """Returns the encoding to use for a request's Accept-Encoding, or None to send the body as it is."""
+    return acceptEncodings.best_match(PREFERENCE)
+
+
+def encodedEtag(etag, encoding):
+    """Returns the ETag of a body compressed with `encoding` from the identity body with ETag `etag`."""
+    return "{0}-{1}".format(etag, encoding)
+
+
+def identityEtag(etag):
+    """Returns the ETag of the identity body an ETag built by encodedEtag stands for, or else the ETag itself."""
+    prefix, _, encoding = etag.rpartition("-")
+    return prefix if prefix and encoding in ENCODINGS else etag
+
+
+def matchingEtag(etag, ifNoneMatch):
+    """Returns the ETag of If-None-Match that stands for the identity ETag `etag` in any encoding, or None."""
+    for candidate in [etag] + [encodedEtag(etag, encoding) for encoding in ENCODINGS]:
+        if candidate in ifNoneMatch:
+            return candidate
+    return None
+
+
+def _setEncodedEtag(response, encoding):
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(encodedEtag(etag, encoding))
+
+
+def gzipStream(chunks):
+    """Compresses a stream of byte chunks, flushing after every chunk so the client can decode it as it comes."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def compressResponse(response, acceptEncodings, variants=None):
+    """Compresses the body of a successful response in the encoding the client prefers.
+
+    `variants` is a dict of compressed bodies by encoding that belongs to a cached body. Variants found there
+    are reused, and new ones are stored there, so a cached body is compressed only once per encoding.
+    """
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype == "text/event-stream":
+        return response
+    response.vary.add("Accept-Encoding")
+
+    if response.is_streamed:
+        if "gzip" in acceptEncodings:
+            response.response = gzipStream(response.iter_encoded())
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers.pop("Content-Length", None)
+            _setEncodedEtag(response, "gzip")
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_SIZE:
+        return response
+    encoding = negotiate(acceptEncodings)
+    if encoding is None:
+        return response
+
+    compressed = variants.get(encoding) if variants is not None else None
+    if compressed is None:
+        compressed = ENCODERS[encoding](body)
+        if variants is not None:
+            variants[encoding] = compressed
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    _setEncodedEtag(response, encoding)
+    return response
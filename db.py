@@ -1,19 +1,246 @@
-from mongoengine import *
-from model import Todo
+from mongoengine import ValidationError
+from model import Todo, TOMBSTONE_RETENTION_DAYS
+from storage import ARCHIVE, TODOS, TOMBSTONES
+import cache
+import events
+import groupcommit
+import metrics
+import serializer
+import storage
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from collections import namedtuple
+import base64
+import binascii
+import hashlib
+import heapq
+import itertools
 import json
 import datetime
 import os
+import time
 from service import sec
 
+MAX_LIMIT = int(os.environ.get("TODOS_MAX_LIMIT", 100))
+MAX_STREAM_LIMIT = int(os.environ.get("TODOS_MAX_STREAM_LIMIT", 100000))
+STREAM_BATCH_SIZE = int(os.environ.get("TODOS_STREAM_BATCH_SIZE", 500))
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 10000))
+MAX_BATCH_IDS = int(os.environ.get("TODOS_MAX_BATCH_IDS", 500))
+# the write concern of POST /todos, with and without GROUP_COMMIT. Empty for the default of the connection
+CREATE_WRITE_CONCERN = storage.writeConcern(os.environ.get("CREATE_WRITE_CONCERN"))
+GROUP_COMMIT_WRITE_CONCERN = storage.writeConcern(os.environ.get("GROUP_COMMIT_WRITE_CONCERN"))
+# writes younger than this may still be in flight, so GET /todos/changes leaves them for the next sync
+SYNC_SETTLE = datetime.timedelta(milliseconds=int(os.environ.get("SYNC_SETTLE_MS", 1000)))
 
+TODO_NOT_FOUND = "Todo matching query does not exist."
+# the version of the todos written before todos had a version, new todos start at 1
+MISSING_VERSION = 0
+UPDATABLE_FIELDS = ["title", "description", "done"]
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# formats the todo listings can be encoded in, besides JSON
+BINARY_FORMATS = ["bson", "msgpack"] if serializer.msgpack is not None else ["bson"]
+
+# db field names of Todo in the order Document.to_json() emits them
+TODO_FIELDS = [Todo._fields[name].db_field for name in Todo._fields_ordered]
+
+# the order of GET /todos, backed by an index in every backend
+PAGE_SORT = [("createdAt", 1), ("_id", 1)]
+
+
+def _millis(value):
+    return (value - _EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def encodeCursor(todo, field="createdAt"):
+    """Builds the opaque keyset cursor pointing right after the given raw document, in (field, _id) order."""
+    position = "{0}:{1}".format(_millis(todo[field]), todo["_id"])
+    return base64.urlsafe_b64encode(position.encode("ascii")).decode("ascii")
+
+
+def decodeCursor(cursor):
+    """Returns the (datetime, _id) pair encoded in a cursor. Raises ValueError for malformed cursors."""
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+        millis, todoId = position.split(":")
+        return _EPOCH + datetime.timedelta(milliseconds=int(millis)), ObjectId(todoId)
+    except (binascii.Error, UnicodeError, InvalidId, ValueError):
+        raise ValueError("Invalid cursor: {0}".format(cursor))
+
+
+def _versionCondition(version):
+    # todos that haven't been backfilled yet have no version field, which is read as MISSING_VERSION
+    if version == MISSING_VERSION:
+        return {"$in": [MISSING_VERSION, None]}
+    return version
+
+
+def _pageKey(todo):
+    return todo["createdAt"], todo["_id"]
+
+
+def keyset(field, position):
+    """Query for the documents that come after a decoded cursor in (field, _id) order."""
+    value, todoId = position
+    return {"$or": [{field: {"$gt": value}}, {field: value, "_id": {"$gt": todoId}}]}
+
+
+def encodeSyncToken(issuedAt, todosCursor, tombstonesCursor):
+    token = {
+        "at": _millis(issuedAt),
+        "todos": todosCursor,
+        "tombstones": tombstonesCursor
+    }
+    return base64.urlsafe_b64encode(json.dumps(token).encode("utf-8")).decode("ascii")
+
+
+def decodeSyncToken(token):
+    """Returns the issue time and the todos and tombstones cursors of a sync token. Raises ValueError if malformed."""
+    try:
+        token = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+        return _EPOCH + datetime.timedelta(milliseconds=int(token["at"])), token["todos"], token["tombstones"]
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise ValueError("Invalid sync token: {0}".format(token))
+
+
+# a cached todo: its JSON bytes, its version and the compressed variants of the JSON by encoding
+CachedTodo = namedtuple("CachedTodo", ["body", "version", "variants"])
+
+
+class SyncTokenExpired(Exception):
+    """Raised for sync tokens older than the retention of the tombstones, as deletions may have been missed."""
+
+
+def todoEtag(todoId, version, format="json"):
+    """Builds the strong ETag of a todo. It changes whenever the todo is written, as every write bumps its version.
+
+    The ETags of the binary formats end with the format, as their bodies differ from the JSON one.
+    """
+    etag = "{0}-{1}".format(str(todoId).lower(), version)
+    return etag if format == "json" else "{0}-{1}".format(etag, format)
+
+
+def etagVersion(todoId, etag):
+    """Returns the version in an ETag built by todoEtag for the given todo, or None if it is not one."""
+    prefix, _, version = etag.rpartition("-")
+    if version in BINARY_FORMATS:
+        prefix, _, version = prefix.rpartition("-")
+    if prefix != str(todoId).lower() or not version.isdigit():
+        return None
+    return int(version)
+
+
+class PreconditionFailed(Exception):
+    """Raised when a write is conditional on a version of the todo that is no longer current."""
+
+
+class TodoPage:
+    """One page of a todo listing.
+
+    The ETag of the page is derived from its format and the ids and versions of its todos, and the body is only
+    serialized when it is asked for, so answering a conditional request with 304 costs no serialization.
+    """
+
+    def __init__(self, todos, nextCursor, encode, format="json"):
+        self.todos = todos
+        self.nextCursor = nextCursor
+        self.format = format
+        self._encode = encode
+
+    @property
+    def etag(self):
+        digest = hashlib.sha1(self.format.encode("ascii"))
+        for todo in self.todos:
+            digest.update("{0}-{1};".format(todo["_id"], todo.get("version", MISSING_VERSION)).encode("ascii"))
+        return digest.hexdigest()
+
+    def encode(self):
+        with metrics.serialization(self.format):
+            return self._encode(self.todos)
+
+
+class RawTodoPage(TodoPage):
+    """A page of RawBSONDocuments, whose ETag is derived from their bytes so that they are never decoded."""
+
+    @property
+    def etag(self):
+        digest = hashlib.sha1(self.format.encode("ascii"))
+        for todo in self.todos:
+            digest.update(todo.raw)
+        return digest.hexdigest()
+
+
+def _batches(todos, encode, format):
+    # the encoding time is summed up per batch, as reading the cursor happens in between
+    batch = []
+    encodingSeconds = 0
+    for todo in todos:
+        startedAt = time.perf_counter()
+        batch.append(encode(todo))
+        encodingSeconds += time.perf_counter() - startedAt
+        if len(batch) == STREAM_BATCH_SIZE:
+            metrics.SERIALIZATION_SECONDS.labels(format).observe(encodingSeconds)
+            yield batch
+            batch = []
+            encodingSeconds = 0
+    if batch:
+        metrics.SERIALIZATION_SECONDS.labels(format).observe(encodingSeconds)
+        yield batch
+
+
+def _ndjsonChunks(todos, encode):
+    for batch in _batches(todos, encode, "json"):
+        yield "\n".join(batch) + "\n"
+
+
+def _arrayChunks(todos, encode):
+    # same layout as json_util.dumps(list) so both response modes produce identical JSON
+    yield "["
+    separator = ""
+    for batch in _batches(todos, encode, "json"):
+        yield separator + ", ".join(batch)
+        separator = ", "
+    yield "]"
+
+
+def _binaryChunks(todos, encode, format):
+    for batch in _batches(todos, encode, format):
+        yield b"".join(batch)
+
+
+@metrics.timedMethods
 class DB:
     def __init__(self):
-        db_name = os.environ.get("DB_NAME", "todos")
+        self.store = storage.createStore()
 
-        if os.environ.get("FLASK_ENV", "development") != "testing":
-            connect(db_name, host="mongo", port=27017, username="admin", password="admin", authentication_source="admin")
-        else:
-            connect(db_name, host="localhost", port=27017)
+        # opt-in read path that skips Document/json_util and encodes raw pymongo documents directly
+        self.fastReads = os.environ.get("DB_FAST_READS", "false").lower() == "true"
+        self.cache = cache.createCache()
+        self.events = events.EventBus(maxSubscribers=int(os.environ.get("EVENTS_MAX_STREAMS", 100)),
+                                      queueSize=int(os.environ.get("EVENTS_QUEUE_SIZE", 1000)))
+        if os.environ.get("EVENTS_SOURCE", "local") == "changestream" and self.store.supportsChangeStreams:
+            self.events.source = events.ChangeStreamSource(self.events, self.store.database, self._todoJson)
+        # opt-in batching of concurrent creates into one insert
+        self.groupCommit = None
+        if os.environ.get("GROUP_COMMIT", "false").lower() == "true":
+            self.groupCommit = groupcommit.GroupCommit(self._insertTodos,
+                                                       maxSize=int(os.environ.get("GROUP_COMMIT_MAX_SIZE", 100)),
+                                                       window=float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 2)) / 1000)
+
+    def reconnect(self):
+        """Opens new connections to the storage backend. Pre-forking servers call this in every worker."""
+        self.store.reconnect()
+
+    def warmUp(self):
+        self.store.warmUp()
+        # todos written before versions and GET /todos/changes existed lack these fields
+        self.store.backfill(TODOS, "version", default=MISSING_VERSION)
+        self.store.backfill(TODOS, "updatedAt", copyFrom="createdAt")
+
+    def close(self):
+        self.store.close()
 
     def createTodo(self, payload):
         auth = sec.context.get_auth()
@@ -23,70 +250,443 @@ class DB:
             createdBy=auth.user_id
         )
         try:
-            newTodo.save()
+            newTodo.validate()
         except ValidationError as error:
             errorMessage = {
                 "msg": str(error)
             }
             return json.dumps(errorMessage)
-            
-        return newTodo.to_json()
+        newTodo.id = ObjectId()
+        if self.groupCommit is not None:
+            writeError = self.groupCommit.submit(newTodo.to_mongo())
+        else:
+            writeError = self.store.insert(TODOS, [newTodo.to_mongo()], writeConcern=CREATE_WRITE_CONCERN).get(0)
+        if writeError is not None:
+            errorMessage = {
+                "msg": writeError
+            }
+            return json.dumps(errorMessage)
+
+        with metrics.serialization("json"):
+            createdTodo = newTodo.to_json().encode("utf-8")
+        self.cache.set(str(newTodo.id), CachedTodo(createdTodo, newTodo.version, {}))
+        self._publish("created", createdTodo.decode("utf-8"), newTodo.createdBy)
+        return createdTodo
+
+    def _insertTodos(self, todos):
+        # flushes a group commit, returning the write error of every todo or None
+        metrics.GROUP_COMMIT_SIZE.observe(len(todos))
+        writeErrors = self.store.insert(TODOS, todos, writeConcern=GROUP_COMMIT_WRITE_CONCERN)
+        return [writeErrors.get(position) for position in range(len(todos))]
+
+    def createTodos(self, payloads):
+        """Validates all payloads and inserts the valid todos with unordered insert_many calls.
+
+        Returns a JSON report with one result per payload, in request order: either the _id of the new todo
+        or the message of the validation or write error. Raises ValueError if there are more than
+        BULK_MAX_ITEMS payloads.
+        """
+        if len(payloads) > BULK_MAX_ITEMS:
+            raise ValueError("At most {0} todos can be created at once".format(BULK_MAX_ITEMS))
+
+        auth = sec.context.get_auth()
+        results = [None] * len(payloads)
+        validTodos = []
+        for index, payload in enumerate(payloads):
+            if not isinstance(payload, dict):
+                results[index] = {"msg": "Todo must be a JSON object"}
+                continue
+            newTodo = Todo(
+                title=payload.get("title"),
+                description=payload.get("description"),
+                createdBy=auth.user_id
+            )
+            try:
+                newTodo.validate()
+            except ValidationError as error:
+                results[index] = {"msg": str(error)}
+                continue
+            validTodos.append((index, newTodo.to_mongo()))
 
-    def getAllTodos(self, limit=10):
-        listTodos = Todo.objects[:limit]
-        return listTodos.to_json()
+        for start in range(0, len(validTodos), BULK_BATCH_SIZE):
+            batch = validTodos[start:start + BULK_BATCH_SIZE]
+            writeErrors = self.store.insert(TODOS, [todo for _, todo in batch])
+            for position, (index, todo) in enumerate(batch):
+                if position in writeErrors:
+                    results[index] = {"msg": writeErrors[position]}
+                else:
+                    results[index] = {"_id": todo["_id"]}
+                    if self.events.active:
+                        self._publish("created", self._todoJson(todo), auth.user_id)
+
+        report = {
+            "inserted": sum(1 for result in results if "_id" in result),
+            "failed": sum(1 for result in results if "msg" in result),
+            "results": results
+        }
+        return json_util.dumps(report)
+
+    def getAllTodos(self, limit=10, after=None, filters=None, format="json", archived=False):
+        """Returns a TodoPage with one page of todos ordered by (createdAt, _id).
+
+        The next cursor of the page is None once the last page has been reached. `filters` are the keyword
+        arguments of `_filterQuery`. `format` is "json" or one of BINARY_FORMATS; bson pages hold the
+        RawBSONDocuments read by the driver. With `archived` the archived todos are listed as well. Raises
+        ValueError if `after` is not a cursor previously returned here.
+        """
+        limit = max(1, min(limit, MAX_LIMIT))
+        page = list(self._findPage(self._pageFilter(after, filters), limit, raw=format == "bson", archived=archived))
+        nextCursor = None
+        if len(page) == limit:
+            nextCursor = encodeCursor(page[-1])
+        if format == "bson":
+            return RawTodoPage(page, nextCursor, serializer.listToBson, format)
+        if format == "msgpack":
+            return TodoPage(page, nextCursor, serializer.listToMsgpack, format)
+        return TodoPage(page, nextCursor, serializer.listToJson if self.fastReads else json_util.dumps)
+
+    def streamTodos(self, limit=None, after=None, ndjson=False, filters=None, format="json", archived=False):
+        """Returns a generator of response chunks with up to `limit` todos, read from the cursor in batches.
+
+        The chunks form either newline-delimited JSON or a single JSON array, or with one of BINARY_FORMATS
+        the encoded todos one after the other. At most one batch of documents is held in memory at a time, so
+        the cost of a stream does not grow with its length.
+        """
+        limit = max(1, min(limit or MAX_STREAM_LIMIT, MAX_STREAM_LIMIT))
+        listTodos = self._findPage(self._pageFilter(after, filters), limit, batchSize=STREAM_BATCH_SIZE,
+                                   raw=format == "bson", archived=archived)
+        if format == "bson":
+            return _binaryChunks(listTodos, serializer.toBson, format)
+        if format == "msgpack":
+            return _binaryChunks(listTodos, serializer.toMsgpack, format)
+
+        encode = serializer.toJson if self.fastReads else json_util.dumps
+        if ndjson:
+            return _ndjsonChunks(listTodos, encode)
+        return _arrayChunks(listTodos, encode)
+
+    def _findPage(self, query, limit, batchSize=None, raw=False, archived=False):
+        todos = self.store.find(TODOS, query, sort=PAGE_SORT, limit=limit, batchSize=batchSize, raw=raw)
+        if not archived:
+            return todos
+        # both collections are read in page order, so merging them keeps the keyset cursors valid
+        archivedTodos = self.store.find(ARCHIVE, query, sort=PAGE_SORT, limit=limit, batchSize=batchSize, raw=raw)
+        return itertools.islice(heapq.merge(todos, archivedTodos, key=_pageKey), limit)
+
+    def _pageFilter(self, after, filters):
+        query = self._filterQuery(required=False, **(filters or {}))
+        if after is not None:
+            after = keyset("createdAt", decodeCursor(after))
+            query = {"$and": [query, after]} if query else after
+        return query
+
+    def getChanges(self, since=None, limit=MAX_LIMIT, createdBy=None):
+        """Returns the todos created or modified and the todos deleted since a sync token, with the next token.
+
+        Both lists are read in (time, _id) order, so every sync costs index scans proportional to the changes
+        only. Without a token the sync starts from the beginning. Raises ValueError for malformed tokens and
+        SyncTokenExpired for tokens older than the retention of the tombstones.
+        """
+        limit = max(1, min(limit, MAX_LIMIT))
+        now = datetime.datetime.now()
+        until = now - SYNC_SETTLE
+        todosCursor, tombstonesCursor = None, None
+        if since is not None:
+            issuedAt, todosCursor, tombstonesCursor = decodeSyncToken(since)
+            if issuedAt < now - datetime.timedelta(days=TOMBSTONE_RETENTION_DAYS):
+                raise SyncTokenExpired("The sync token has expired, start a new sync without a token")
+
+        changed = list(self._changesQuery(TODOS, "updatedAt", todosCursor, until, createdBy, limit))
+        deleted = list(self._changesQuery(TOMBSTONES, "deletedAt", tombstonesCursor, until, createdBy, limit))
+        if changed:
+            todosCursor = encodeCursor(changed[-1], field="updatedAt")
+        if deleted:
+            tombstonesCursor = encodeCursor(deleted[-1], field="deletedAt")
+
+        changes = {
+            "changed": changed,
+            "deleted": deleted,
+            "more": len(changed) == limit or len(deleted) == limit,
+            "next": encodeSyncToken(until, todosCursor, tombstonesCursor)
+        }
+        with metrics.serialization("json"):
+            if self.fastReads:
+                return serializer.toJson(changes)
+            return json_util.dumps(changes)
+
+    def _changesQuery(self, collection, field, cursor, until, createdBy, limit):
+        conditions = [{field: {"$lt": until}}]
+        if createdBy is not None:
+            conditions.append({"createdBy": createdBy})
+        if cursor is not None:
+            conditions.append(keyset(field, decodeCursor(cursor)))
+        return self.store.find(collection, {"$and": conditions}, sort=[(field, 1), ("_id", 1)], limit=limit)
 
     def getTodoById(self, todoId):
-        try:
-            extistingTodo = Todo.objects.get(id=todoId)
-        except Todo.DoesNotExist as error:
+        return self.lookupTodo(todoId).body
+
+    def lookupTodo(self, todoId):
+        """Returns the CachedTodo of a todo, or one with an error message and no version if it doesn't exist."""
+        cachedTodo = self.cache.get(todoId.lower())
+        if cachedTodo is not None:
+            return cachedTodo
+
+        fillToken = self.cache.fillToken()
+        extistingTodo = self.store.findOne(TODOS, self._todoFilter(todoId))
+        if extistingTodo is None:
             errorMessage = {
-                "msg": str(error)
+                "msg": TODO_NOT_FOUND
+            }
+            return CachedTodo(json.dumps(errorMessage), None, None)
+
+        cachedTodo = CachedTodo(self._todoJson(extistingTodo).encode("utf-8"), extistingTodo.get("version", MISSING_VERSION), {})
+        self.cache.fill(todoId.lower(), cachedTodo, fillToken)
+        return cachedTodo
+
+    def getTodoVersion(self, todoId):
+        """Returns the current version of a todo, or None if it doesn't exist. Only reads the version field."""
+        cachedTodo = self.cache.get(todoId.lower())
+        if cachedTodo is not None:
+            return cachedTodo.version
+        extistingTodo = self.store.findOne(TODOS, self._todoFilter(todoId), fields=["version"])
+        if extistingTodo is None:
+            return None
+        return extistingTodo.get("version", MISSING_VERSION)
+
+    def getEncodedTodo(self, todoId, format):
+        """Returns a todo encoded in one of BINARY_FORMATS and its version, or None if it doesn't exist.
+
+        The todo cache only holds JSON, so these are always read from the database.
+        """
+        todo = self.store.findOne(TODOS, self._todoFilter(todoId), raw=format == "bson")
+        if todo is None:
+            return None
+        with metrics.serialization(format):
+            if format == "bson":
+                return serializer.toBson(todo), todo.get("version", MISSING_VERSION)
+            return serializer.toMsgpack(serializer.reorder(todo, TODO_FIELDS)), todo.get("version", MISSING_VERSION)
+
+    def getTodosByIds(self, todoIds):
+        """Returns a JSON array with the todo for each of the given ids, in the same order.
+
+        Cached todos are served from the cache and the rest are read with a single $in query. Ids that don't
+        match a todo get an entry with the id and an error message instead. Raises ValueError if more than
+        MAX_BATCH_IDS ids are requested.
+        """
+        if len(todoIds) > MAX_BATCH_IDS:
+            raise ValueError("At most {0} todos can be fetched at once".format(MAX_BATCH_IDS))
+
+        found = {}
+        missing = []
+        for todoId in todoIds:
+            key = todoId.lower()
+            if key in found:
+                continue
+            cachedTodo = self.cache.get(key)
+            if cachedTodo is not None:
+                found[key] = cachedTodo
+            elif ObjectId.is_valid(key):
+                missing.append(ObjectId(key))
+
+        if missing:
+            fillToken = self.cache.fillToken()
+            for extistingTodo in self.store.find(TODOS, {"_id": {"$in": missing}}):
+                key = str(extistingTodo["_id"])
+                found[key] = CachedTodo(self._todoJson(extistingTodo).encode("utf-8"), extistingTodo.get("version", MISSING_VERSION), {})
+                self.cache.fill(key, found[key], fillToken)
+
+        listTodos = []
+        for todoId in todoIds:
+            if todoId.lower() in found:
+                listTodos.append(found[todoId.lower()].body.decode("utf-8"))
+            else:
+                errorMessage = {
+                    "id": todoId,
+                    "msg": TODO_NOT_FOUND
+                }
+                listTodos.append(json.dumps(errorMessage))
+        return "[" + ", ".join(listTodos) + "]"
+
+    def _todoJson(self, todo):
+        """Serializes a raw todo document the same way Document.to_json() does."""
+        if "version" not in todo:
+            # Document would fill in the default version, which doesn't match the ETag
+            todo = dict(todo, version=MISSING_VERSION)
+        with metrics.serialization("json"):
+            if self.fastReads:
+                return serializer.toJson(serializer.reorder(todo, TODO_FIELDS))
+            return Todo._from_son(todo).to_json()
+
+    def deleteTodo(self, todoId, expectedVersion=None):
+        """Deletes a todo. With `expectedVersion`, raises PreconditionFailed if the todo has been modified since."""
+        query = self._todoFilter(todoId)
+        if expectedVersion is not None:
+            query["version"] = _versionCondition(expectedVersion)
+        deletedTodo = self.store.findOneAndDelete(TODOS, query, fields=["title", "createdBy"])
+        if deletedTodo is None:
+            self._checkVersionConflict(todoId, expectedVersion)
+            errorMessage = {
+                "msg": TODO_NOT_FOUND
             }
             return json.dumps(errorMessage)
-        return extistingTodo.to_json()
+        self.cache.delete(str(deletedTodo["_id"]))
+        self._tombstone([deletedTodo])
 
-    def deleteTodo(self, todoId):
+        message = {
+            "msg": "The todo with title: {0} is now deleted".format(deletedTodo.get("title"))
+        }
+        return json.dumps(message)
+
+    def updateTodo(self, todoId, payload, expectedVersion=None):
+        return self.modifyTodo(todoId, payload, expectedVersion).body
+
+    def modifyTodo(self, todoId, payload, expectedVersion=None):
+        """Updates a todo and returns its new CachedTodo, or one with an error message and no version.
+
+        With `expectedVersion`, raises PreconditionFailed if the todo has been modified since that version.
+        """
         try:
-            deletedTodo = Todo.objects.get(id=todoId)
-        except Todo.DoesNotExist as error:
+            changes = self._changes(payload)
+        except ValidationError as error:
             errorMessage = {
                 "msg": str(error)
             }
-            return json.dumps(errorMessage)
+            return CachedTodo(json.dumps(errorMessage), None, None)
 
-        deletedTodoTitle = deletedTodo.title
+        if not changes:
+            return self.lookupTodo(todoId)
+
+        query = self._todoFilter(todoId)
+        if expectedVersion is not None:
+            query["version"] = _versionCondition(expectedVersion)
+        # a single find_one_and_update, so concurrent updates of different fields don't overwrite each other
+        updatedTodo = self.store.findOneAndUpdate(TODOS, query, changes, {"version": 1})
+        if updatedTodo is None:
+            self._checkVersionConflict(todoId, expectedVersion)
+            errorMessage = {
+                "msg": TODO_NOT_FOUND
+            }
+            return CachedTodo(json.dumps(errorMessage), None, None)
+
+        createdBy = updatedTodo.get("createdBy")
+        updatedTodo = CachedTodo(self._todoJson(updatedTodo).encode("utf-8"), updatedTodo.get("version", MISSING_VERSION), {})
+        self.cache.set(todoId.lower(), updatedTodo)
+        self._publish("updated", updatedTodo.body.decode("utf-8"), createdBy)
+        return updatedTodo
+
+    def updateTodos(self, filters, payload):
+        """Applies the same changes to every todo matching the filters with a single update_many.
+
+        Raises ValueError if no filter is given or there is nothing to update.
+        """
         try:
-            deletedTodo.delete()
-        except Todo.DoesNotExist as error:
+            changes = self._changes(payload)
+        except ValidationError as error:
             errorMessage = {
                 "msg": str(error)
             }
             return json.dumps(errorMessage)
-        
+        if not changes:
+            raise ValueError("Nothing to update")
+
+        matched, modified = self.store.updateMany(TODOS, self._filterQuery(**filters), changes, {"version": 1})
+        self.cache.clear()
+        # the modified todos are not known one by one: subscribers should catch up with GET /todos/changes
+        self._publish("resync", json.dumps({"modified": modified}), filters.get("createdBy"))
+
         message = {
-            "msg": "The todo with title: {0} is now deleted".format(deletedTodoTitle)
+            "matched": matched,
+            "modified": modified
         }
         return json.dumps(message)
 
-    def updateTodo(self, todoId, payload):
-        try:
-            updateTodo = Todo.objects.get(id=todoId)
-        except Todo.DoesNotExist as error:
-            errorMessage = {
-                "msg": str(error)
-            }
-            return json.dumps(errorMessage)
+    def deleteTodos(self, filters):
+        """Deletes every todo matching the filters, BULK_BATCH_SIZE todos per delete_many.
+
+        Raises ValueError if no filter is given.
+        """
+        query = self._filterQuery(**filters)
+        deleted = 0
+        position = None
+        while True:
+            # the ids are needed for the tombstones, and deleting by id leaves todos that match only later alone
+            batchQuery = query if position is None else {"$and": [query, keyset("createdAt", position)]}
+            batch = list(self.store.find(TODOS, batchQuery, sort=PAGE_SORT, limit=BULK_BATCH_SIZE,
+                                         fields=["createdBy", "createdAt"]))
+            if not batch:
+                break
+            # tombstoned first, so that a delete is never missed by GET /todos/changes
+            self._tombstone(batch)
+            deleted += self.store.deleteMany(TODOS, {"_id": {"$in": [todo["_id"] for todo in batch]}})
+            if len(batch) < BULK_BATCH_SIZE:
+                break
+            position = (batch[-1]["createdAt"], batch[-1]["_id"])
+        self.cache.clear()
+
+        message = {
+            "deleted": deleted
+        }
+        return json.dumps(message)
+
+    def _changes(self, payload):
+        """Returns the validated field changes requested by an update payload."""
+        changes = {}
+        for field in UPDATABLE_FIELDS:
+            if payload.get(field) is not None:
+                Todo._fields[field].validate(payload.get(field))
+                changes[field] = payload.get(field)
+        if payload.get("done") is True:
+            changes["completedAt"] = datetime.datetime.now()
+        if changes:
+            changes["updatedAt"] = datetime.datetime.now()
+        return changes
+
+    def _tombstone(self, deletedTodos):
+        """Records the deletion of raw todos for GET /todos/changes."""
+        if not deletedTodos:
+            return
+        deletedAt = datetime.datetime.now()
+        tombstones = [{"_id": todo["_id"], "createdBy": todo.get("createdBy"), "deletedAt": deletedAt} for todo in deletedTodos]
+        # fails for todos whose concurrent delete already left a tombstone
+        self.store.insert(TOMBSTONES, tombstones)
+        for todo in deletedTodos:
+            self._publish("deleted", json_util.dumps({"_id": todo["_id"]}), todo.get("createdBy"))
+
+    def _publish(self, name, data, createdBy):
+        """Publishes an event of a write of this process, unless the events come from a change stream."""
+        if self.events.source is None:
+            self.events.publish(name, data, createdBy)
+
+    def _filterQuery(self, done=None, createdBy=None, ids=None, createdAfter=None, createdBefore=None,
+                     completedAfter=None, completedBefore=None, required=True):
+        """Builds the raw Mongo query for the todo filters. Every combination is backed by an index of Todo.
 
-        if payload.get("title") is not None:
-            updateTodo.title = payload.get("title")
-        if payload.get("description") is not None:
-            updateTodo.description = payload.get("description")
-        if payload.get("done") is not None:
-            updateTodo.done = payload.get("done")
-            if updateTodo.done is True:
-                updateTodo.completedAt = datetime.datetime.now()
+        Ranges include their lower bound and exclude the upper one. Raises ValueError if the filters are
+        invalid, or if none is given and `required` is set.
+        """
+        query = {}
+        if done is not None:
+            query["done"] = done
+        if createdBy is not None:
+            query["createdBy"] = createdBy
+        for field, lower, upper in [("createdAt", createdAfter, createdBefore), ("completedAt", completedAfter, completedBefore)]:
+            if lower is not None:
+                query.setdefault(field, {})["$gte"] = lower
+            if upper is not None:
+                query.setdefault(field, {})["$lt"] = upper
+        if ids is not None:
+            try:
+                query["_id"] = {"$in": [ObjectId(todoId) for todoId in ids]}
+            except (InvalidId, TypeError):
+                raise ValueError("Invalid todo ids: {0}".format(",".join(ids)))
+        if required and not query:
+            raise ValueError("At least one filter is required")
+        return query
 
-        updateTodo.save()
+    def _checkVersionConflict(self, todoId, expectedVersion):
+        """Called when a conditional write matched nothing: tells a stale version apart from a missing todo."""
+        if expectedVersion is not None and self.store.count(TODOS, self._todoFilter(todoId)) > 0:
+            raise PreconditionFailed("The todo has been modified since version {0}".format(expectedVersion))
 
-        return updateTodo.to_json()
\ No newline at end of file
+    def _todoFilter(self, todoId):
+        return {"_id": Todo._fields["id"].to_mongo(todoId)}
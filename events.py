@@ -0,0 +1,139 @@
+"""Push notifications of todo changes, served as Server-Sent Events by GET /todos/events.
+
+Events come from one of two sources. By default `DB` publishes an event after each of its own writes. That
+only covers the writes made by the same process. With EVENTS_SOURCE=changestream, a Mongo change stream
+feeds the events instead, so every write on the replica set is seen. Every subscriber gets a bounded queue.
+A subscriber that falls behind gets a final "overflow" event and is disconnected, instead of holding back the
+writers or buffering without limit. It can then catch up with GET /todos/changes and subscribe again.
+"""
+import itertools
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    """Raised when a worker already serves as many event streams as it is allowed to."""
+
+
+class Subscription:
+    def __init__(self, bus, createdBy, queueSize):
+        self.bus = bus
+        self.createdBy = createdBy
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=queueSize)
+
+    def offer(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def stream(self, heartbeat):
+        """Yields the events of the subscription as SSE frames, with a comment every `heartbeat` seconds."""
+        try:
+            yield "retry: 3000\n\n"
+            while not self.overflowed:
+                try:
+                    eventId, name, data = self._queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield "id: {0}\nevent: {1}\ndata: {2}\n\n".format(eventId, name, data)
+            yield "event: overflow\ndata: {}\n\n"
+        finally:
+            self.close()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """In-process publish/subscribe of todo changes."""
+
+    def __init__(self, maxSubscribers=100, queueSize=1000):
+        self.maxSubscribers = maxSubscribers
+        self.queueSize = queueSize
+        self.source = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, createdBy=None):
+        """Returns a new subscription to the events of the todos created by `createdBy`, or of all todos."""
+        if self.source is not None:
+            self.source.start()
+        with self._lock:
+            if self.maxSubscribers <= 0:
+                raise TooManySubscribers("Event streams are not served by this worker")
+            if len(self._subscribers) >= self.maxSubscribers:
+                raise TooManySubscribers("At most {0} event streams are served at once".format(self.maxSubscribers))
+            subscription = Subscription(self, createdBy, self.queueSize)
+            self._subscribers.add(subscription)
+            return subscription
+
+    @property
+    def active(self):
+        """Whether anyone listens, so that publishers can skip building events nobody will receive."""
+        return bool(self._subscribers)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, name, data, createdBy=None):
+        """Sends an event to the matching subscribers. Events without `createdBy` go to every subscriber."""
+        with self._lock:
+            if not self._subscribers:
+                return
+            event = (next(self._ids), name, data)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if createdBy is None or subscription.createdBy is None or subscription.createdBy == createdBy:
+                subscription.offer(event)
+
+
+class ChangeStreamSource:
+    """Publishes the changes seen by a Mongo change stream on the todo collections. Requires a replica set."""
+
+    def __init__(self, bus, database, todoJson):
+        self.bus = bus
+        self.database = database
+        self.todoJson = todoJson
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts watching on a background thread of this process, unless it already does."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="change-stream", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": ["todo", "todo_tombstone"]}}}]
+        resumeToken = None
+        while True:
+            try:
+                with self.database().watch(pipeline, full_document="updateLookup", resume_after=resumeToken) as changes:
+                    for change in changes:
+                        resumeToken = change["_id"]
+                        self._publish(change)
+            except Exception as error:
+                log.warning("change stream failed, resuming in 1s: %s", error)
+                time.sleep(1)
+
+    def _publish(self, change):
+        operation = change["operationType"]
+        document = change.get("fullDocument")
+        if change["ns"]["coll"] == "todo_tombstone":
+            # deletions are taken from the tombstones, which unlike the delete events still know the creator
+            if operation == "insert":
+                self.bus.publish("deleted", '{{"_id": {{"$oid": "{0}"}}}}'.format(document["_id"]), document.get("createdBy"))
+        elif operation in ("insert", "update", "replace") and document is not None:
+            name = "created" if operation == "insert" else "updated"
+            self.bus.publish(name, self.todoJson(document), document.get("createdBy"))
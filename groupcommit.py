@@ -0,0 +1,70 @@
+"""Group commit of concurrent writes.
+
+Instead of one round trip to the database per write, concurrent writes are collected into a batch that is
+written with a single call. The first write of a batch becomes its leader: it waits until the batch holds
+`maxSize` writes or `window` seconds have passed, then writes the whole batch while the other writers of the
+batch wait for it. A write that comes alone is delayed by the window, so this only pays off when requests
+overlap, for example with several gunicorn threads per worker.
+"""
+import threading
+import time
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit:
+    """Batches the items of concurrent `submit` calls into calls of `flush`.
+
+    `flush` gets the list of items and must return the list of their results, in the same order.
+    """
+
+    def __init__(self, flush, maxSize=100, window=0.002):
+        self.flush = flush
+        self.maxSize = maxSize
+        self.window = window
+        self._lock = threading.Lock()
+        self._closed = threading.Condition(self._lock)
+        self._batch = None
+
+    def submit(self, item):
+        """Adds an item to the open batch and returns its result once the batch is written.
+
+        Raises the error of `flush` when writing the batch failed.
+        """
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            position = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.maxSize:
+                self._batch = None
+                self._closed.notify_all()
+            elif leader:
+                deadline = time.monotonic() + self.window
+                while self._batch is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._batch = None
+                        break
+                    self._closed.wait(remaining)
+
+        if leader:
+            try:
+                batch.results = self.flush(batch.items)
+            except Exception as error:
+                batch.error = error
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[position]
@@ -0,0 +1,72 @@
+"""Gunicorn settings for running the service in production.
+
+    gunicorn -c gunicorn.conf.py service:app
+
+The app is loaded once in the master and forked into the workers. The master drops its Mongo connection
+before every fork and each worker opens its own pool right after, so no socket is shared between processes.
+FLASK_ENV and DB_NAME keep the same meaning as with `flask run`.
+"""
+import os
+import tempfile
+
+# the app is preloaded in the master: tell it to leave the warm-up to the forked workers
+os.environ["SERVICE_PREFORK"] = "true"
+
+# every worker writes its metrics to files in this directory, so that /metrics can add up all workers
+if not os.environ.get("prometheus_multiproc_dir"):
+    os.environ["prometheus_multiproc_dir"] = tempfile.mkdtemp(prefix="todos-metrics-")
+
+
+def availableCpus():
+    """Returns the number of CPUs this process may use, honouring the cgroup CPU quota of the container."""
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpuMax:  # cgroup v2
+            quota, period = cpuMax.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quotaFile, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as periodFile:
+                quota, period = quotaFile.read().strip(), periodFile.read().strip()
+        except OSError:
+            return cpus
+    if quota in ("max", "-1"):
+        return cpus
+    return max(1, min(cpus, int(quota) // int(period)))
+
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 0)) or availableCpus() * 2 + 1
+# the gthread worker keeps answering the heartbeat of the master while its threads serve requests, so a
+# long-lived event stream neither blocks the worker nor gets it killed by the timeout
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+if worker_class in ("sync", "gthread"):
+    # every event stream holds a thread while it is open: half the threads are left to the other requests, and
+    # a single-threaded worker serves no streams at all
+    os.environ["EVENTS_MAX_STREAMS"] = str(min(int(os.environ.get("EVENTS_MAX_STREAMS", 100)), threads // 2))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+preload_app = True
+accesslog = "-"
+
+
+def pre_fork(server, worker):
+    import service
+    service.db.close()
+
+
+def post_fork(server, worker):
+    import service
+    service.db.reconnect()
+    service.startup.warmUpInBackground(service.db.warmUp)
+
+
+def worker_exit(server, worker):
+    import service
+    service.db.close()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
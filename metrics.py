@@ -0,0 +1,133 @@
+"""Prometheus metrics of the service, exposed at /metrics.
+
+Besides the request counters and latencies per route, the time of a request is broken down into the security
+chain, the `DB` methods, serialization and the MongoDB commands, which pymongo reports through command
+monitoring, and the requests admitted and shed by the admission control are counted. Recording a sample is a
+lock and a few additions, so the metrics are always on.
+
+Under gunicorn every worker records its own samples. With `prometheus_multiproc_dir` set, as
+`gunicorn.conf.py` does, they are written to files in that directory and /metrics sums up all workers.
+"""
+import functools
+import os
+import time
+from flask import g, request
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import REGISTRY, multiprocess
+from pymongo import monitoring
+import requesthooks
+
+# most of the work timed below takes micro- to milliseconds
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, float("inf"))
+
+REQUESTS = Counter("todos_http_requests_total", "HTTP requests by route and status.",
+                   ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("todos_http_request_duration_seconds",
+                            "Time to build the response, up to the first chunk for streamed responses.",
+                            ["method", "route"])
+SECURITY_SECONDS = Histogram("todos_security_duration_seconds",
+                             "Time spent in the security chain, by whether the request was let through.",
+                             ["outcome"], buckets=FAST_BUCKETS)
+DB_SECONDS = Histogram("todos_db_duration_seconds", "Time spent in the methods of DB.",
+                       ["method"], buckets=FAST_BUCKETS)
+SERIALIZATION_SECONDS = Histogram("todos_serialization_duration_seconds", "Time spent encoding todos.",
+                                  ["format"], buckets=FAST_BUCKETS)
+MONGO_COMMAND_SECONDS = Histogram("todos_mongo_command_duration_seconds",
+                                  "Duration of MongoDB commands, as reported by the driver.",
+                                  ["command", "outcome"], buckets=FAST_BUCKETS)
+
+ADMITTED_REQUESTS = Counter("todos_admitted_requests_total", "Requests let through by admission control, by check.",
+                            ["check"])
+SHED_REQUESTS = Counter("todos_shed_requests_total", "Requests rejected by admission control, by check.", ["check"])
+GROUP_COMMIT_SIZE = Histogram("todos_group_commit_size", "Number of todos inserted together by a group commit.",
+                              buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf")))
+
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, "succeeded").observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, "failed").observe(event.duration_micros / 1e6)
+
+
+# only applies to clients created afterwards, so this module must be imported before connecting
+monitoring.register(MongoCommandListener())
+
+
+def instrument(app):
+    """Records the requests handled by a Flask app."""
+
+    @app.before_request
+    def startTimer():
+        g.requestStartedAt = time.perf_counter()
+
+    requesthooks.onRequestEnd(app, _recordRequest)
+
+
+def _recordRequest(status):
+    startedAt = g.pop("requestStartedAt", None)
+    if startedAt is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUESTS.labels(request.method, route, status).inc()
+    REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - startedAt)
+
+
+def timedSecurity(secure, fn):
+    """Same as `secure(fn)`, recording the time from the call until the security chain lets it reach `fn`."""
+    def passed(*args, **kwargs):
+        SECURITY_SECONDS.labels("passed").observe(time.perf_counter() - g.securityStartedAt)
+        g.securityPassed = True
+        return fn(*args, **kwargs)
+
+    securedFn = secure(passed)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        g.securityStartedAt = time.perf_counter()
+        g.securityPassed = False
+        response = securedFn(*args, **kwargs)
+        if not g.securityPassed:
+            SECURITY_SECONDS.labels("rejected").observe(time.perf_counter() - g.securityStartedAt)
+        return response
+    return wrapper
+
+
+def timedMethods(cls):
+    """Class decorator that records the time of every public method in DB_SECONDS."""
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith("_"):
+            setattr(cls, name, _timed(method, DB_SECONDS, name))
+    return cls
+
+
+def _timed(fn, histogram, label):
+    # the labelled child is looked up on every call, so that none is created before the workers are forked
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        startedAt = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.labels(label).observe(time.perf_counter() - startedAt)
+    return wrapper
+
+
+def serialization(format):
+    """Context manager that records the time of its block as serialization time of the given format."""
+    return SERIALIZATION_SECONDS.labels(format).time()
+
+
+def exposition():
+    """Returns the body and the content type of the /metrics response."""
+    if os.environ.get("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
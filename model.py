@@ -1,5 +1,11 @@
 from mongoengine import *
 import datetime
+import os
+
+# how long deletions are remembered for GET /todos/changes
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get("TOMBSTONE_RETENTION_DAYS", 30))
+# how long archived todos are kept, 0 keeps them forever
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", 0))
 
 
 class Todo(Document):
@@ -8,4 +14,64 @@ class Todo(Document):
     done = BooleanField(required=True, default=False)
     createdAt = DateTimeField(default=datetime.datetime.now)
     completedAt = DateTimeField()
-    createdBy = StringField()
\ No newline at end of file
+    createdBy = StringField()
+    # bumped by every update, drives the ETags of the todo
+    version = IntField(default=1)
+    # set by every write, drives GET /todos/changes
+    updatedAt = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        "indexes": [
+            # GET /todos is always sorted on (createdAt, _id), so every filter that can be combined with the
+            # listing gets an index ending with the sort keys. See DB._filterQuery.
+            ("createdAt", "id"),
+            ("createdBy", "createdAt", "id"),
+            ("createdBy", "done", "createdAt", "id"),
+            ("done", "createdAt", "id"),
+            # also walks the archival job through the completed todos in its (completedAt, _id) order
+            ("done", "completedAt", "id"),
+            ("createdBy", "completedAt"),
+            # delta sync, see DB.getChanges
+            ("updatedAt", "id"),
+            ("createdBy", "updatedAt", "id"),
+        ]
+    }
+
+
+class TodoTombstone(Document):
+    """Left behind by a deleted todo, so that GET /todos/changes can report the deletion."""
+    id = ObjectIdField(primary_key=True)
+    createdBy = StringField()
+    deletedAt = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        "collection": "todo_tombstone",
+        "indexes": [
+            ("deletedAt", "id"),
+            ("createdBy", "deletedAt", "id"),
+            {"fields": ["deletedAt"], "expireAfterSeconds": TOMBSTONE_RETENTION_DAYS * 24 * 3600},
+        ]
+    }
+
+
+class ArchivedTodo(Document):
+    """A completed todo moved out of the todo collection by the archival job, see archival.py."""
+    title = StringField(required=True)
+    description = StringField(required=True)
+    done = BooleanField(required=True, default=False)
+    createdAt = DateTimeField(default=datetime.datetime.now)
+    completedAt = DateTimeField()
+    createdBy = StringField()
+    version = IntField(default=1)
+    updatedAt = DateTimeField(default=datetime.datetime.now)
+    archivedAt = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        "collection": "todo_archive",
+        "indexes": [
+            # read together with the todo collection by GET /todos?include=archived
+            ("createdAt", "id"),
+            ("createdBy", "createdAt", "id"),
+        ] + ([{"fields": ["archivedAt"], "expireAfterSeconds": ARCHIVE_RETENTION_DAYS * 24 * 3600}]
+             if ARCHIVE_RETENTION_DAYS > 0 else [])
+    }
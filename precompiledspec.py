@@ -0,0 +1,57 @@
+"""Serving of the precompiled OpenAPI spec.
+
+`build_apispec.py` compiles the spec from the view docstrings into a JSON file at build time. The service
+loads that file once and serves it from memory, with a strong ETag and a gzip variant compressed up front.
+The compiled spec records a digest of the routes and docstrings it was built from, so that the service can
+tell a stale file from a current one without compiling the spec again.
+"""
+import gzip
+import hashlib
+import json
+from flask import request, Response
+import compression
+
+# the field of the compiled spec that holds the digest of its sources
+SOURCE_DIGEST_FIELD = "x-source-digest"
+
+
+def sourceDigest(app):
+    """Returns a digest of the routes of a Flask app and the docstrings of their views."""
+    digest = hashlib.sha256()
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: (rule.rule, rule.endpoint)):
+        # the views of Flasgger serve the spec and are not part of it, and the spec view is replaced once loaded
+        if rule.endpoint.startswith("flasgger."):
+            continue
+        view = app.view_functions.get(rule.endpoint)
+        for part in (rule.rule, ",".join(sorted(rule.methods)), getattr(view, "__doc__", None) or ""):
+            digest.update(part.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class PrecompiledSpec:
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9)
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.sourceDigest = json.loads(body.decode("utf-8")).get(SOURCE_DIGEST_FIELD)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as specFile:
+            return cls(specFile.read())
+
+    def serve(self, **kwargs):
+        """Responds with the spec, or with 304 Not Modified if the client already has this version."""
+        matchedEtag = compression.matchingEtag(self.etag, request.if_none_match)
+        if matchedEtag is not None:
+            response = Response(status=304)
+            response.set_etag(matchedEtag)
+        elif "gzip" in request.accept_encodings:
+            response = Response(self.gzipped, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(compression.encodedEtag(self.etag, "gzip"))
+        else:
+            response = Response(self.body, mimetype="application/json")
+            response.set_etag(self.etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
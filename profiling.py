@@ -0,0 +1,143 @@
+"""On-demand profiling of single requests.
+
+A request runs under cProfile when it carries `X-Profile: true` and the token of a caller with the admin role,
+or when it is picked at random with the probability in PROFILE_SAMPLE_RATE. The token of a request with the
+header is verified before the profiler starts, on every route, so anonymous and non-admin callers never turn
+the profiler on. The profiler is enabled in the first `before_request` and disabled in the last
+`after_request` handler, so it covers the view, the `DB` methods and the serialization and compression of the
+response, and the security chain of sampled requests; requested profiles find the token already verified. The
+body of a streamed response is produced afterwards, and is not part of the profile.
+
+The last PROFILE_BUFFER_SIZE profiles are kept in memory by each worker.
+"""
+import collections
+import cProfile
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from flask import g, request
+import requesthooks
+
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+ADMIN_ROLE = os.environ.get("ADMIN_ROLE", "admin")
+PROFILE_HEADER = "X-Profile"
+
+# the self time of every function in a profile is added to the first area that matches its file or name
+AREAS = [
+    ("serialization", ("serializer.py", "json_util", "/json/", "_json", "msgpack")),
+    ("compression", ("compression.py", "gzip", "zlib", "brotli", "zstandard")),
+    ("security", ("tokencache.py", "microkubes", "jwt", "cryptography", "oauth")),
+    ("database", ("db.py", "model.py", "cache.py", "mongoengine", "pymongo", "bson")),
+    ("view", ("service.py",)),
+    ("framework", ("flask", "werkzeug", "flasgger", "prometheus_client", "metrics.py")),
+]
+
+
+def isAdmin(auth):
+    roles = getattr(auth, "roles", None) or []
+    if isinstance(roles, str):
+        roles = roles.split(",")
+    return ADMIN_ROLE in roles
+
+
+class Profiles:
+    """Bounded buffer of the most recent profiles, the oldest ones are dropped first."""
+
+    def __init__(self, maxProfiles):
+        self._profiles = collections.deque(maxlen=maxProfiles)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, method, path, status, seconds, reason, stats):
+        profile = {
+            "id": next(self._ids),
+            "method": method,
+            "path": path,
+            "status": status,
+            "seconds": round(seconds, 6),
+            "reason": reason,
+            "profiledAt": time.time(),
+            "areas": areas(stats),
+            "stats": marshal.dumps(stats)
+        }
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self):
+        """Returns the summaries of the profiles, newest first."""
+        with self._lock:
+            profiles = list(self._profiles)
+        return [{key: value for key, value in profile.items() if key != "stats"} for profile in reversed(profiles)]
+
+    def get(self, profileId):
+        with self._lock:
+            for profile in self._profiles:
+                if profile["id"] == profileId:
+                    return profile
+        return None
+
+
+class _Snapshot:
+    # what pstats.Stats needs to read the stats of a finished profile
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def textReport(profile, limit=50):
+    """Formats a stored profile as the pstats report sorted by cumulative time."""
+    report = io.StringIO()
+    stats = pstats.Stats(_Snapshot(marshal.loads(profile["stats"])), stream=report)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return report.getvalue()
+
+
+def areas(stats):
+    """Sums up the self time of the functions in the stats of a profile per area of the service."""
+    totals = collections.OrderedDict((area, 0.0) for area, _ in AREAS)
+    totals["other"] = 0.0
+    for (fileName, _, functionName), (_, _, selfTime, _, _) in stats.items():
+        location = fileName + functionName
+        area = next((area for area, parts in AREAS if any(part in location for part in parts)), "other")
+        totals[area] += selfTime
+    return {area: round(seconds, 6) for area, seconds in totals.items()}
+
+
+def instrument(app, profiles, authenticate):
+    """Profiles the requests of a Flask app. Must be called before any other request hook is registered.
+
+    `authenticate` verifies the token of the current request and returns its auth context, or None.
+    """
+
+    @app.before_request
+    def startProfiler():
+        if (request.headers.get(PROFILE_HEADER, "").lower() == "true" and request.headers.get("Authorization")
+                and isAdmin(authenticate())):
+            reason = "requested"
+        elif SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+            reason = "sampled"
+        else:
+            return
+        profiler = cProfile.Profile()
+        g.profile = (profiler, reason, time.perf_counter())
+        profiler.enable()
+
+    requesthooks.onRequestEnd(app, lambda status: _stop(profiles, status))
+
+
+def _stop(profiles, status):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profiler, reason, startedAt = profile
+    profiler.disable()
+    seconds = time.perf_counter() - startedAt
+    profiler.create_stats()
+    profiles.add(request.method, request.path, status, seconds, reason, profiler.stats)
@@ -0,0 +1,20 @@
+"""Request hooks shared by the instrumentation of the Flask app."""
+
+
+def onRequestEnd(app, record):
+    """Calls `record(status)` with the status of every request of a Flask app once it has been handled.
+
+    after_request is skipped when the view raised, so those requests are recorded with status 500 from
+    teardown_request instead. Both run when an after_request handler raised, so `record` must ignore a second
+    call for the same request.
+    """
+
+    @app.after_request
+    def recordResponse(response):
+        record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def recordError(error):
+        if error is not None:
+            record(500)
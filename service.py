@@ -1,46 +1,199 @@
+import time
+_importStartedAt = time.monotonic()
+
 import os
+import datetime
+import functools
 from flask import Flask
 from microkubes.gateway import KongGatewayRegistrator
-from flask import request
+from flask import request, Response, make_response, g
 import json
 from microkubes.security import FlaskSecurity
 from flasgger import Swagger
+from tokencache import VerifiedTokenCache
+from startup import Startup
+from events import TooManySubscribers
+from precompiledspec import PrecompiledSpec, sourceDigest
+import admission
+import compression
+import metrics
+import profiling
 
 app = Flask(__name__)
-Swagger(app)
+# the last profiled requests, see profiling.py
+profiles = profiling.Profiles(int(os.environ.get("PROFILE_BUFFER_SIZE", 20)))
+# admins are told apart by the security chain, which is set up below
+profiling.instrument(app, profiles, lambda: verifiedAuth())
+swagger = Swagger(app)
+metrics.instrument(app)
+# requests beyond MAX_IN_FLIGHT per worker are shed, except for the probes and the metrics
+inFlight = admission.InFlightLimiter(int(os.environ.get("MAX_IN_FLIGHT", 0)))
+admission.instrument(app, inFlight, exempt=["/healthz", "/readyz", "/metrics"])
+
+startup = Startup(_importStartedAt)
+
 
+KEYS_DIR = os.environ.get("KEYS_DIR", "./keys")
 
 # set up a security chain
 sec = (FlaskSecurity().
-        keys_dir("./keys").   # set up a key-store that has at least the public keys from the platform
+        keys_dir(KEYS_DIR).   # set up a key-store that has at least the public keys from the platform
         jwt().                # Add JWT support
         oauth2().             # Add OAuth2 support
         build())              # Build the security for Flask
 
+# tokens that already passed the security chain, so that repeated calls skip the signature verification
+tokens = VerifiedTokenCache(KEYS_DIR,
+                            maxSize=int(os.environ.get("TOKEN_CACHE_SIZE", 10000)),
+                            maxTtl=float(os.environ.get("TOKEN_CACHE_MAX_TTL", 600)))
+
+
+def verifiedAuth():
+    """Runs the security chain for the current request outside of a view. Returns the auth context, or None."""
+    verified = []
+    tokens.secured(sec, lambda: verified.append(sec.context.get_auth()))()
+    return verified[0] if verified else None
+
+
+# per-caller request rates of the /todos API, see admission.py
+readLimit = admission.RateLimiter("reads", float(os.environ.get("RATE_LIMIT_READS", 0)),
+                                  burst=float(os.environ.get("RATE_LIMIT_READS_BURST", 0)))
+writeLimit = admission.RateLimiter("writes", float(os.environ.get("RATE_LIMIT_WRITES", 0)),
+                                   burst=float(os.environ.get("RATE_LIMIT_WRITES_BURST", 0)))
+
+
+def secured(fn):
+    """Secures a view like sec.secured, verifying every token only once until it expires."""
+    @functools.wraps(fn)
+    def authenticated(*args, **kwargs):
+        g.auth = sec.context.get_auth()
+        return fn(*args, **kwargs)
+    return metrics.timedSecurity(functools.partial(tokens.secured, sec), authenticated)
+
+
+def optionallySecured(fn):
+    """Runs the security chain only for requests that carry an Authorization header.
+
+    Anonymous requests are let through, while authenticated ones are verified, so the view can rely on
+    sec.context.get_auth() whenever the header is present.
+    """
+    securedFn = secured(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if request.headers.get("Authorization") is not None:
+            return securedFn(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return wrapper
+
 if os.environ.get("FLASK_ENV", "development") != "testing":
     registrator = KongGatewayRegistrator(os.environ.get("API_GATEWAY_URL", "http://localhost:8001"))  # Use the Kong registrator for Microkubes
-    # Self-registration on the API Gateway must be the first thing we do when running this service.
-    # If the registration fails, then the whole service must terminate.
-    registrator.register(name="microservice-python-example",                  # the service name.
+    # Self-registration on the API Gateway is retried in the background, so a slow gateway doesn't hold up the start.
+    # If the registration keeps failing, then the whole service must terminate.
+    startup.registerInBackground(lambda: registrator.register(
+                        name="microservice-python-example",                  # the service name.
                         paths=["/"],                      # URL pattern that Kong will use to redirect requests to out service
                         host="microservice-python-example.service.consul",  # The hostname of the service.
-                        port=5000)                             # Flask default port. When redirecting, Kong will call us on this port.
+                        port=5000),                            # Flask default port. When redirecting, Kong will call us on this port.
+                        maxAttempts=int(os.environ.get("REGISTRATION_MAX_ATTEMPTS", 10)))
 
-from db import DB
+from db import DB, PreconditionFailed, SyncTokenExpired, todoEtag, etagVersion, MAX_LIMIT, BINARY_FORMATS
 db = DB()
+
+# media types of the binary formats todos can be read in, for internal callers
+MEDIA_TYPES = {
+    "bson": "application/bson",
+    "msgpack": "application/msgpack"
+}
+
+
+def _binaryFormat(*mediaTypes):
+    """Returns the binary format the Accept header prefers over the given media types, or None."""
+    best = request.accept_mimetypes.best_match(list(mediaTypes) + [MEDIA_TYPES[format] for format in BINARY_FORMATS])
+    for format in BINARY_FORMATS:
+        if MEDIA_TYPES[format] == best:
+            return format
+    return None
  
 @app.route("/todos", methods=["GET"])
+@optionallySecured
+@admission.rateLimited(readLimit)
 def todos():
     """
     This is the todo listing API.
-    Call this api passing a limit and get back all the todos in the limit range.
+    Call this api passing a limit and get back one page of todos, ordered by creation time.
+    When more todos are available, the X-Next-Cursor response header holds the cursor of the next page.
+    Authenticated calls only list the todos of the caller, unless a createdBy filter is given.
+    Internal callers can send "Accept application/bson" or "Accept application/msgpack" for a binary encoding
+    of the todos: BSON documents or MessagePack objects one after the other when streaming, a MessagePack
+    array or the BSON documents one after the other for a page.
     ---
+    produces:
+        - application/json
+        - application/x-ndjson
+        - application/bson
+        - application/msgpack
     parameters:
+      - name: done
+        in: query
+        type: boolean
+        required: false
+        description: Only list todos with this done state
+      - name: createdBy
+        in: query
+        type: string
+        required: false
+        description: Only list todos created by this user. Use "me" for the authenticated user and "*" for all users.
+      - name: createdAfter
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only list todos created at or after this local time, without a time zone
+      - name: createdBefore
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only list todos created before this local time, without a time zone
+      - name: completedAfter
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only list todos completed at or after this local time, without a time zone
+      - name: completedBefore
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only list todos completed before this local time, without a time zone
       - name: limit
         in: query
         type: integer
         required: false
-        description: The number of Todos to return
+        description: The number of Todos to return (at most 100 by default)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: The cursor returned in X-Next-Cursor by the previous page
+      - name: ids
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of todo ids to fetch. The todos are returned in the same order, missing ones as an id with an error message.
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        description: Stream the todos as a chunked JSON array. Send "Accept application/x-ndjson" to stream one todo per line instead.
+      - name: include
+        in: query
+        type: string
+        enum: [archived]
+        required: false
+        description: Also list the completed todos moved to the archive, which carry an archivedAt field.
     definitions:
         Todo:
             type: object
@@ -69,15 +222,32 @@ def todos():
                     properties:
                         $date:
                             type: integer
+                createdBy:
+                    type: string
+                    description: The id of the user that created the todo.
+                version:
+                    type: integer
+                    description: Incremented on every update of the todo.
         Todos:
             type: array
             items:
                 $ref: '#/definitions/Todo'
     responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        304:
+            description: The page has not changed since the ETag sent in If-None-Match.
         400:
             description: Input validation error.
         200:
-            description: All todos have been listed.
+            description: A page of todos has been listed.
+            headers:
+                ETag:
+                    type: string
+                    description: Changes whenever a todo on the page is added, modified or removed.
+                X-Next-Cursor:
+                    type: string
+                    description: Cursor of the next page. Missing on the last page.
             schema:
                 $ref: '#/definitions/Todos'
             examples:
@@ -109,15 +279,206 @@ def todos():
                     }
                 ]
     """
-    if request.args.get("limit") is not None: 
-        limitTodos = int(request.args.get("limit"))
+    ndjson = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+    binaryFormat = _binaryFormat("application/json", "application/x-ndjson")
+    try:
+        include = request.args.get("include")
+        if include not in (None, "archived"):
+            raise ValueError("include must be archived")
+        archived = include == "archived"
+
+        if request.args.get("ids") is not None:
+            return db.getTodosByIds(request.args.get("ids").split(","))
+
+        limitTodos = request.args.get("limit")
+        if limitTodos is not None:
+            try:
+                limitTodos = int(limitTodos)
+            except ValueError:
+                raise ValueError("limit must be a number")
+        if ndjson or request.args.get("stream") == "true":
+            chunks = db.streamTodos(limit=limitTodos, after=request.args.get("after"), ndjson=ndjson,
+                                    filters=_todoFilters(defaultToUser=True), format=binaryFormat or "json",
+                                    archived=archived)
+            if binaryFormat is not None:
+                return Response(chunks, mimetype=MEDIA_TYPES[binaryFormat])
+            return Response(chunks, mimetype="application/x-ndjson" if ndjson else "application/json")
+
+        page = db.getAllTodos(limit=10 if limitTodos is None else limitTodos, after=request.args.get("after"),
+                              filters=_todoFilters(defaultToUser=True), format=binaryFormat or "json",
+                              archived=archived)
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+
+    matchedEtag = compression.matchingEtag(page.etag, request.if_none_match)
+    if matchedEtag is not None:
+        response = Response(status=304)
+    elif binaryFormat is not None:
+        response = Response(page.encode(), mimetype=MEDIA_TYPES[binaryFormat])
     else:
-        limitTodos = 10
-    listTodos = db.getAllTodos(limit=limitTodos)
-    return listTodos
+        response = make_response(page.encode())
+    response.set_etag(matchedEtag or page.etag)
+    response.vary.add("Accept")
+    if page.nextCursor is not None:
+        response.headers["X-Next-Cursor"] = page.nextCursor
+    return response
+
+@app.route("/todos", methods=["PATCH"])
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
+def updateTodos():
+    """
+    This is the API for updating all todos matching a filter.
+    Call this api passing at least one filter and the changes to apply. All matching todos are updated at once.
+    ---
+    parameters:
+      - name: done
+        in: query
+        type: boolean
+        required: false
+        description: Only update todos with this done state
+      - name: createdBy
+        in: query
+        type: string
+        required: false
+        description: Only update todos created by this user, by default the authenticated user. Use "*" to update the todos of all users.
+      - name: ids
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of todo ids to update
+      - name: updated todo info
+        in: body
+        description: The changes to apply to every matching todo.
+        schema:
+            type: object
+            properties:
+                title:
+                    type: string
+                description:
+                    type: string
+                done:
+                    type: boolean
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: No filter, nothing to update, or invalid filter values.
+        200:
+            description: The matching todos are updated.
+            schema:
+                properties:
+                    matched:
+                        type: integer
+                    modified:
+                        type: integer
+    """
+    try:
+        updatedTodos = db.updateTodos(_bulkFilters(), request.get_json(silent=True) or {})
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    return updatedTodos
+
+@app.route("/todos", methods=["DELETE"])
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
+def deleteTodos():
+    """
+    This is the API for deleting all todos matching a filter.
+    Call this api passing at least one filter. All matching todos are deleted at once.
+    ---
+    parameters:
+      - name: done
+        in: query
+        type: boolean
+        required: false
+        description: Only delete todos with this done state
+      - name: createdBy
+        in: query
+        type: string
+        required: false
+        description: Only delete todos created by this user, by default the authenticated user. Use "*" to delete the todos of all users.
+      - name: ids
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of todo ids to delete
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: No filter or invalid filter values.
+        200:
+            description: The matching todos are deleted.
+            schema:
+                properties:
+                    deleted:
+                        type: integer
+    """
+    try:
+        deletedTodos = db.deleteTodos(_bulkFilters())
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    return deletedTodos
+
+def _todoFilters(defaultToUser=False):
+    """Reads the todo filters from the query string.
+
+    createdBy=me stands for the authenticated user. With `defaultToUser`, authenticated requests without a
+    createdBy filter only see their own todos, and createdBy=* lifts that default.
+    """
+    filters = {}
+    done = request.args.get("done")
+    if done is not None:
+        if done not in ("true", "false"):
+            raise ValueError("done must be true or false")
+        filters["done"] = done == "true"
+
+    authenticated = request.headers.get("Authorization") is not None
+    createdBy = request.args.get("createdBy")
+    if createdBy is None and defaultToUser and authenticated:
+        createdBy = "me"
+    if createdBy == "me":
+        if not authenticated:
+            raise ValueError("createdBy=me requires authentication")
+        createdBy = sec.context.get_auth().user_id
+    if createdBy is not None and createdBy != "*":
+        filters["createdBy"] = createdBy
+
+    for name in ["createdAfter", "createdBefore", "completedAfter", "completedBefore"]:
+        if request.args.get(name) is not None:
+            try:
+                filters[name] = datetime.datetime.fromisoformat(request.args.get(name))
+            except ValueError:
+                raise ValueError("{0} must be an ISO 8601 date".format(name))
+            # the dates of the todos are stored in the local time of the service, without an offset
+            if filters[name].tzinfo is not None:
+                raise ValueError("{0} must be an ISO 8601 date without a time zone".format(name))
+    if request.args.get("ids") is not None:
+        filters["ids"] = request.args.get("ids").split(",")
+    return filters
+
+def _bulkFilters():
+    """Reads the filters of a bulk write, which only touches the todos of the caller unless createdBy is given.
+
+    Raises ValueError unless at least one filter is given, so that a bare request never touches every todo.
+    """
+    if not _todoFilters():
+        raise ValueError("At least one filter is required")
+    return _todoFilters(defaultToUser=True)
 
 @app.route("/todos", methods=["POST"])
-@sec.secured   # this action is now secure
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
 def createTodo():
     """
     This is the API for creating todos.
@@ -140,6 +501,8 @@ def createTodo():
                     description:
                         type: string
     responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
         400:
             description: The title and/or description are not provided.
         200:
@@ -163,51 +526,295 @@ def createTodo():
     newTodo = db.createTodo(payload)
     return newTodo
 
+@app.route("/todos/bulk", methods=["POST"])
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
+def createTodos():
+    """
+    This is the API for creating many todos at once.
+    Send a JSON array of todos, or one todo per line with Content-Type application/x-ndjson.
+    ---
+    summary: Creates many todos.
+    consumes:
+        - application/json
+        - application/x-ndjson
+    parameters:
+          - in: body
+            name: todos
+            description: The todos to create.
+            schema:
+                type: array
+                items:
+                    type: object
+                    properties:
+                        title:
+                            type: string
+                        description:
+                            type: string
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: The body is not an array of todos or has too many items.
+        200:
+            description: The todos have been processed. Each result holds either the new _id or an error message.
+            examples:
+                {
+                    "inserted": 1,
+                    "failed": 1,
+                    "results": [
+                        {
+                            "_id": {
+                                "$oid": "5be9d46127ad405ec67488c9"
+                            }
+                        },
+                        {
+                            "msg": "ValidationError (Todo:None) (Field is required: ['description'])"
+                        }
+                    ]
+                }
+    """
+    try:
+        if request.mimetype == "application/x-ndjson":
+            payloads = [json.loads(line) for line in request.stream if line.strip()]
+        else:
+            payloads = request.get_json(silent=True)
+            if not isinstance(payloads, list):
+                raise ValueError("Expected a JSON array of todos")
+        report = db.createTodos(payloads)
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    return report
+
+@app.route("/todos/changes", methods=["GET"])
+@optionallySecured
+@admission.rateLimited(readLimit)
+def todoChanges():
+    """
+    This is the delta sync API.
+    Call this api passing the token returned by the previous call and get back only the todos that were created,
+    modified or deleted since then, plus the token for the next call. Without a token the sync starts from scratch.
+    Keep calling while "more" is true. Authenticated calls only sync the todos of the caller.
+    ---
+    parameters:
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: The token returned in "next" by the previous call
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: The maximal number of changed and of deleted todos to return
+      - name: createdBy
+        in: query
+        type: string
+        required: false
+        description: Only sync todos created by this user. Use "me" for the authenticated user and "*" for all users.
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: Invalid token or filter.
+        410:
+            description: The token is too old to tell which todos were deleted. Start over without a token.
+        200:
+            description: The changes since the token.
+            examples:
+                {
+                    "changed": [
+                        {
+                            "_id": {
+                                "$oid": "5be9d46127ad405ec67488c9"
+                            },
+                            "title": "Title 1",
+                            "description": "Description 1",
+                            "done": false,
+                            "createdAt": {
+                                "$date": 1542054513199
+                            },
+                            "version": 1,
+                            "updatedAt": {
+                                "$date": 1542054513199
+                            }
+                        }
+                    ],
+                    "deleted": [
+                        {
+                            "_id": {
+                                "$oid": "5be9d46a27ad405ec67488ca"
+                            },
+                            "deletedAt": {
+                                "$date": 1542206121677
+                            }
+                        }
+                    ],
+                    "more": false,
+                    "next": "eyJhdCI6IDE1NDIyMDYxMjE2NzcsICJ0b2RvcyI6IG51bGwsICJ0b21ic3RvbmVzIjogbnVsbH0="
+                }
+    """
+    try:
+        filters = _todoFilters(defaultToUser=True)
+        changes = db.getChanges(since=request.args.get("since"), limit=int(request.args.get("limit", MAX_LIMIT)),
+                                createdBy=filters.get("createdBy"))
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    except SyncTokenExpired as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 410
+    return changes
+
+@app.route("/todos/events", methods=["GET"])
+@optionallySecured
+@admission.rateLimited(readLimit)
+def todoEvents():
+    """
+    This is the todo events API.
+    Call this api to get a Server-Sent Events stream with an event for every todo that is created ("created"),
+    updated ("updated") or deleted ("deleted"). After a bulk update a "resync" event asks the client to catch up
+    with GET /todos/changes. A client that can't keep up gets an "overflow" event and is disconnected.
+    Authenticated calls only get the events of the todos of the caller.
+    ---
+    produces:
+        - text/event-stream
+    parameters:
+      - name: createdBy
+        in: query
+        type: string
+        required: false
+        description: Only stream events of todos created by this user. Use "me" for the authenticated user and "*" for all users.
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: Invalid filter.
+        503:
+            description: The service already serves as many event streams as it can, or serves none on a single-threaded worker.
+        200:
+            description: The event stream. The data of each event is the todo, or its _id for deleted todos.
+    """
+    try:
+        filters = _todoFilters(defaultToUser=True)
+        subscription = db.events.subscribe(createdBy=filters.get("createdBy"))
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    except TooManySubscribers as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        # retrying doesn't help on a worker that serves no streams at all
+        headers = {"Retry-After": "5"} if db.events.maxSubscribers > 0 else {}
+        return json.dumps(errorMessage), 503, headers
+
+    response = Response(subscription.stream(heartbeat=float(os.environ.get("EVENTS_HEARTBEAT", 15))),
+                        mimetype="text/event-stream")
+    response.call_on_close(subscription.close)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@app.route("/todos/lookup", methods=["POST"])
+@admission.rateLimited(readLimit)
+def lookupTodos():
+    """
+    This is the API for fetching many todos by their IDs.
+    Same as GET /todos?ids=..., for lists of ids that are too long for a query string.
+    ---
+    consumes:
+        - application/json
+    parameters:
+          - in: body
+            name: ids
+            description: The ids of the todos to fetch.
+            schema:
+                type: object
+                properties:
+                    ids:
+                        type: array
+                        items:
+                            type: string
+    responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        400:
+            description: The ids are missing or there are too many of them.
+        200:
+            description: The todos in the requested order. Missing todos are listed as the id with an error message.
+            examples:
+                [
+                    {
+                        "_id": {
+                            "$oid": "5be9d46127ad405ec67488c9"
+                        },
+                        "title": "Title 1",
+                        "description": "Description 1",
+                        "done": false,
+                        "createdAt": {
+                            "$date": 1542054513199
+                        }
+                    },
+                    {
+                        "id": "5be9d45627ad405ec67488c8",
+                        "msg": "Todo matching query does not exist."
+                    }
+                ]
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        todoIds = payload.get("ids")
+        if not isinstance(todoIds, list) or not all(isinstance(todoId, str) for todoId in todoIds):
+            raise ValueError("Expected a list of todo ids")
+        listTodos = db.getTodosByIds(todoIds)
+    except ValueError as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 400
+    return listTodos
+
 @app.route("/todos/<todoId>", methods=["GET"])
+@admission.rateLimited(readLimit)
 def getTodoById(todoId):
     """
     This is the todo listing API using the todo ID.
     Call this api passing a todoId and get back the todo to with the ID that was provided..
+    Send "Accept application/bson" or "Accept application/msgpack" to get the todo in a binary encoding.
     ---
+    produces:
+        - application/json
+        - application/bson
+        - application/msgpack
     parameters:
       - name: todoId
         in: path
         type: string
         required: true
         description: The id of the Todo
-    definitions:
-        Todo:
-            type: object
-            properties:
-                _id:
-                    type: object
-                    properties:
-                        $oid:
-                            type: string
-                title:
-                    type: string
-                    description: Todo title
-                description:
-                    type: string
-                    description: Todo description
-                done:
-                    type: boolean
-                    description: Shows if the todo is completed or not.
-                createdAt:
-                    type: object
-                    properties:
-                        $date: 
-                            type: integer
-                completedAt:
-                    type: object
-                    properties:
-                        $date:
-                            type: integer
     responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
+        304:
+            description: The todo has not changed since the ETag sent in If-None-Match.
         400:
             description: Todo matching query does not exist.
         200:
             description: The todo is listed.
+            headers:
+                ETag:
+                    type: string
+                    description: The version of the todo, for If-None-Match and If-Match.
             schema:
                 $ref: '#/definitions/Todo'
             examples:
@@ -223,12 +830,51 @@ def getTodoById(todoId):
                     },
                 }
     """
+    binaryFormat = _binaryFormat("application/json")
+    if request.if_none_match:
+        version = db.getTodoVersion(todoId)
+        matchedEtag = (compression.matchingEtag(todoEtag(todoId, version, binaryFormat or "json"), request.if_none_match)
+                       if version is not None else None)
+        if matchedEtag is not None:
+            response = Response(status=304)
+            response.set_etag(matchedEtag)
+            response.vary.add("Accept")
+            return response
+
+    encodedTodo = db.getEncodedTodo(todoId, binaryFormat) if binaryFormat is not None else None
+    if encodedTodo is not None:
+        body, version = encodedTodo
+        response = Response(body, mimetype=MEDIA_TYPES[binaryFormat])
+        response.set_etag(todoEtag(todoId, version, binaryFormat))
+    else:
+        response = _todoResponse(todoId, db.lookupTodo(todoId))
+    response.vary.add("Accept")
+    return response
 
-    existingTodo = db.getTodoById(todoId)
-    return existingTodo
+def _todoResponse(todoId, cachedTodo):
+    response = make_response(cachedTodo.body)
+    if cachedTodo.version is not None:
+        response.set_etag(todoEtag(todoId, cachedTodo.version))
+    # lets compressTodos reuse the compressed bodies kept with the cached todo
+    g.compressionVariants = cachedTodo.variants
+    return response
+
+def _expectedVersion(todoId):
+    """Returns the version of the todo a write is conditional on, from If-Match.
+
+    Raises PreconditionFailed if If-Match holds no ETag of this todo.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match.as_set():
+        version = etagVersion(todoId, compression.identityEtag(etag))
+        if version is not None:
+            return version
+    raise PreconditionFailed("If-Match holds no ETag of this todo")
 
 @app.route("/todos/<todoId>", methods=["DELETE"])
-@sec.secured   # this action is now secure
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
 def deleteTodo(todoId):
     """
     This is the todo deleting API.
@@ -240,37 +886,13 @@ def deleteTodo(todoId):
         type: string
         required: true
         description: The id of the Todo
-    definitions:
-        Todo:
-            type: object
-            properties:
-                _id:
-                    type: object
-                    properties:
-                        $oid:
-                            type: string
-                title:
-                    type: string
-                    description: Todo title
-                description:
-                    type: string
-                    description: Todo description
-                done:
-                    type: boolean
-                    description: Shows if the todo is completed or not.
-                createdAt:
-                    type: object
-                    properties:
-                        $date:
-                            type: integer
-                completedAt:
-                    type: object
-                    properties:
-                        $date:
-                            type: integer
     responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
         400:
             description: Todo matching query does not exist.
+        412:
+            description: The todo has been modified since the version sent in If-Match.
         200:
             description: The todo has been deleted.
             schema:
@@ -279,11 +901,18 @@ def deleteTodo(todoId):
                         type: string
                         description: This field will display a message that the todo has been deleted.
     """
-    deletedTodo = db.deleteTodo(todoId)
+    try:
+        deletedTodo = db.deleteTodo(todoId, expectedVersion=_expectedVersion(todoId))
+    except PreconditionFailed as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 412
     return deletedTodo
 
 @app.route("/todos/<todoId>", methods=["PUT", "PATCH"])
-@sec.secured   # this action is now secure
+@secured   # this action is now secure
+@admission.rateLimited(writeLimit)
 def updateTodo(todoId):
     """
     This is the todo updating API using the todo ID.
@@ -307,39 +936,19 @@ def updateTodo(todoId):
                     type: string
                 done:
                     type: boolean
-    definitions:
-        Todo:
-            type: object
-            properties:
-                _id:
-                    type: object
-                    properties:
-                        $oid:
-                            type: string
-                title:
-                    type: string
-                    description: Todo title
-                description:
-                    type: string
-                    description: Todo description
-                done:
-                    type: boolean
-                    description: Shows if the todo is completed or not.
-                createdAt:
-                    type: object
-                    properties:
-                        $date:
-                            type: integer
-                completedAt:
-                    type: object
-                    properties:
-                        $date:
-                            type: integer
     responses:
+        429:
+            description: The caller made too many requests, retry after the seconds in Retry-After.
         400:
             description: Todo matching query does not exist.
+        412:
+            description: The todo has been modified since the version sent in If-Match.
         200:
             description: The todo is updated.
+            headers:
+                ETag:
+                    type: string
+                    description: The new version of the todo.
             schema:
                 $ref: '#/definitions/Todo'
             examples:
@@ -356,5 +965,193 @@ def updateTodo(todoId):
                 }
     """
     payload = request.get_json()
-    updatedTodo = db.updateTodo(todoId, payload)
-    return updatedTodo
\ No newline at end of file
+    try:
+        updatedTodo = db.modifyTodo(todoId, payload, expectedVersion=_expectedVersion(todoId))
+    except PreconditionFailed as error:
+        errorMessage = {
+            "msg": str(error)
+        }
+        return json.dumps(errorMessage), 412
+    return _todoResponse(todoId, updatedTodo)
+
+@app.after_request
+def compressTodos(response):
+    """Compresses the /todos responses in the encoding negotiated from Accept-Encoding."""
+    if request.path == "/todos" or request.path.startswith("/todos/"):
+        return compression.compressResponse(response, request.accept_encodings, g.get("compressionVariants"))
+    return response
+
+@app.route("/cache/stats", methods=["GET"])
+def cacheStats():
+    """
+    This is the API for inspecting the todo cache.
+    Returns the hit, miss and eviction counters of the cache in front of GET /todos/{todoId}.
+    ---
+    responses:
+        200:
+            description: The cache counters.
+    """
+    return json.dumps(db.cache.stats())
+
+@app.route("/cache/tokens/stats", methods=["GET"])
+def tokenCacheStats():
+    """
+    This is the API for inspecting the verified-token cache.
+    Returns the hit, miss and eviction counters of the cache in front of the security chain.
+    ---
+    responses:
+        200:
+            description: The cache counters.
+    """
+    return json.dumps(tokens.stats())
+
+@app.route("/metrics", methods=["GET"])
+def metricsExposition():
+    """
+    This is the Prometheus metrics API.
+    Returns the request counters and latencies per route, and the time spent in the security chain, the
+    database layer, serialization and MongoDB commands, in the Prometheus text format.
+    ---
+    produces:
+        - text/plain
+    responses:
+        200:
+            description: The metrics of the service.
+    """
+    body, contentType = metrics.exposition()
+    return Response(body, content_type=contentType)
+
+@app.route("/profiles", methods=["GET"])
+@secured   # this action is now secure
+def listProfiles():
+    """
+    This is the API for listing the profiled requests.
+    Send "X-Profile true" with any request of an admin to profile it, or set PROFILE_SAMPLE_RATE to profile a
+    share of all requests. The most recent profiles of the worker are listed, newest first, with their self
+    time summed up per area of the service. Only admins can call this api.
+    ---
+    responses:
+        403:
+            description: The caller is not an admin.
+        200:
+            description: The profiles.
+            examples:
+                [
+                    {
+                        "id": 2,
+                        "method": "PUT",
+                        "path": "/todos/5be9d46127ad405ec67488c9",
+                        "status": 200,
+                        "seconds": 0.012345,
+                        "reason": "requested",
+                        "profiledAt": 1542054513.199,
+                        "areas": {
+                            "serialization": 0.000412,
+                            "compression": 0.0,
+                            "security": 0.006012,
+                            "database": 0.003217,
+                            "view": 0.000051,
+                            "framework": 0.000953,
+                            "other": 0.000402
+                        }
+                    }
+                ]
+    """
+    if not profiling.isAdmin(g.get("auth")):
+        return json.dumps({"msg": "Only admins can read profiles"}), 403
+    return json.dumps(profiles.list())
+
+@app.route("/profiles/<int:profileId>", methods=["GET"])
+@secured   # this action is now secure
+def getProfile(profileId):
+    """
+    This is the API for reading one profile.
+    Returns the profile as a pstats report sorted by cumulative time, or with "format=pstats" as a pstats
+    file that can be loaded with pstats.Stats or snakeviz. Only admins can call this api.
+    ---
+    produces:
+        - text/plain
+        - application/octet-stream
+    parameters:
+      - name: profileId
+        in: path
+        type: integer
+        required: true
+        description: The id of the profile
+      - name: format
+        in: query
+        type: string
+        required: false
+        description: The format of the profile, text (default) or pstats
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: The number of functions in the text report (50 by default)
+    responses:
+        403:
+            description: The caller is not an admin.
+        404:
+            description: The profile is not or no longer kept.
+        200:
+            description: The profile.
+    """
+    if not profiling.isAdmin(g.get("auth")):
+        return json.dumps({"msg": "Only admins can read profiles"}), 403
+    profile = profiles.get(profileId)
+    if profile is None:
+        return json.dumps({"msg": "Profile not found"}), 404
+    if request.args.get("format") == "pstats":
+        response = Response(profile["stats"], mimetype="application/octet-stream")
+        response.headers["Content-Disposition"] = "attachment; filename=profile-{0}.pstats".format(profileId)
+        return response
+    return Response(profiling.textReport(profile, request.args.get("limit", 50, type=int)), mimetype="text/plain")
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    This is the liveness probe.
+    ---
+    responses:
+        200:
+            description: The service is running.
+    """
+    return json.dumps({"status": "ok"})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    This is the readiness probe.
+    The service is ready once it is connected to the database and the connection pool is warmed up.
+    The response also reports the registration on the API gateway and the startup timings.
+    ---
+    responses:
+        503:
+            description: The service is still warming up.
+        200:
+            description: The service is ready to take traffic.
+            examples:
+                {
+                    "ready": true,
+                    "registered": true,
+                    "importSeconds": 0.412,
+                    "readySeconds": 0.537
+                }
+    """
+    status = startup.status()
+    return json.dumps(status), 200 if status["ready"] else 503
+
+# serve the spec compiled by build_apispec.py instead of parsing the view docstrings on every request
+APISPEC_FILE = os.environ.get("APISPEC_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "apispec.json"))
+if os.path.exists(APISPEC_FILE):
+    apispec = PrecompiledSpec.load(APISPEC_FILE)
+    if apispec.sourceDigest == sourceDigest(app):
+        app.view_functions["flasgger.apispec_1"] = apispec.serve
+    else:
+        app.logger.warning("%s doesn't match the view docstrings and is ignored, run python build_apispec.py",
+                           APISPEC_FILE)
+
+startup.imported()
+# pre-forking servers warm up every worker after the fork instead, see gunicorn.conf.py
+if os.environ.get("SERVICE_PREFORK") != "true":
+    startup.warmUpInBackground(db.warmUp)
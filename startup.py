@@ -0,0 +1,78 @@
+"""Startup of the service.
+
+Nothing that depends on other services blocks the import of the app: the registration on the API gateway and
+the warm-up of the database (connecting, ensuring the indexes and filling the connection pool) run on
+background threads and are retried with exponential backoff. The service reports ready once the warm-up has
+completed. The time spent importing the app and the time until it became ready are recorded so that
+cold-start regressions can be tracked.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def retry(task, name, initialDelay=0.5, maxDelay=30, maxAttempts=None):
+    """Calls `task` until it succeeds, doubling the delay between attempts. Returns False if all attempts failed."""
+    delay = initialDelay
+    attempt = 1
+    while True:
+        try:
+            task()
+            return True
+        except Exception as error:
+            if maxAttempts is not None and attempt >= maxAttempts:
+                log.error("%s failed after %d attempts: %s", name, attempt, error)
+                return False
+            log.warning("%s failed (attempt %d), retrying in %.1fs: %s", name, attempt, delay, error)
+        time.sleep(delay)
+        delay = min(delay * 2, maxDelay)
+        attempt += 1
+
+
+class Startup:
+    def __init__(self, startedAt):
+        self.startedAt = startedAt
+        self.importSeconds = None
+        self.readySeconds = None
+        self.registered = False
+        self.ready = threading.Event()
+
+    def imported(self):
+        self.importSeconds = time.monotonic() - self.startedAt
+        log.info("service imported in %.3fs", self.importSeconds)
+
+    def registerInBackground(self, register, maxAttempts=None):
+        """Registers the service on the API gateway on a background thread.
+
+        The service can't be reached through the gateway without the registration, so if it still fails after
+        `maxAttempts` the process is terminated, as it was when the registration ran at import time.
+        """
+        def run():
+            if retry(register, "Gateway registration", maxAttempts=maxAttempts):
+                self.registered = True
+            else:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Thread(target=run, name="gateway-registration", daemon=True).start()
+
+    def warmUpInBackground(self, warmUp):
+        """Runs the warm-up on a background thread and marks the service as ready once it succeeds."""
+        def run():
+            retry(warmUp, "Warm-up")
+            self.readySeconds = time.monotonic() - self.startedAt
+            self.ready.set()
+            log.info("service ready in %.3fs", self.readySeconds)
+
+        threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+    def status(self):
+        return {
+            "ready": self.ready.is_set(),
+            "registered": self.registered,
+            "importSeconds": self.importSeconds,
+            "readySeconds": self.readySeconds
+        }
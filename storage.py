@@ -0,0 +1,536 @@
+"""Storage backends of the todos, behind `DB`.
+
+`DB` goes through a TodoStore for every read and write. Documents are dicts in the layout of
+`Document.to_mongo()`, and queries use the part of the MongoDB query language that `DB` builds: equality,
+$gt, $gte, $lt, $lte, $in, $and and $or.
+
+MongoTodoStore is the production backend. MemoryTodoStore keeps the todos in the memory of the process, so
+that the tests and the benchmarks run without a MongoDB server. Every process has its own MemoryTodoStore,
+so it is only meant for a single worker, and its tombstones and archived todos never expire.
+"""
+import bisect
+import os
+import threading
+from bson import BSON, ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from mongoengine.connection import connect, disconnect
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
+from model import ArchivedTodo, Todo, TodoTombstone
+
+# collection names, the same in every backend
+TODOS = "todo"
+TOMBSTONES = "todo_tombstone"
+ARCHIVE = "todo_archive"
+
+# documents updated per round trip when a field is backfilled from another one
+BACKFILL_BATCH_SIZE = 1000
+
+DOCUMENTS = {TODOS: Todo, TOMBSTONES: TodoTombstone, ARCHIVE: ArchivedTodo}
+
+# reads documents as RawBSONDocuments, which keep the bytes from the server and decode fields only on access
+RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+
+class TodoStore:
+    """Interface for the storage backends. `collection` is one of TODOS, TOMBSTONES and ARCHIVE."""
+
+    # whether DB.events can follow the writes of all processes through a change stream of `database()`
+    supportsChangeStreams = False
+
+    def reconnect(self):
+        """Opens new connections, dropping the current ones if there are any."""
+        raise NotImplementedError()
+
+    def warmUp(self):
+        """Prepares the backend for the first requests."""
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def drop(self):
+        """Deletes the documents of all collections."""
+        raise NotImplementedError()
+
+    def insert(self, collection, documents, writeConcern=None):
+        """Inserts documents, setting the _id of those that don't have one.
+
+        A failing document doesn't stop the others. Returns the error messages of the failed documents by
+        their position in `documents`. `writeConcern` is the `w` of the MongoDB write concern, None for the
+        default of the connection. Backends without replicas ignore it.
+        """
+        raise NotImplementedError()
+
+    def find(self, collection, query, sort=None, limit=0, fields=None, batchSize=None, raw=False):
+        """Returns an iterable of the documents matching a query.
+
+        `sort` is a list of (field, direction) pairs, `limit` 0 means no limit and `fields` restricts the
+        returned fields to the given ones and _id. With `raw` the documents are RawBSONDocuments.
+        """
+        raise NotImplementedError()
+
+    def findOne(self, collection, query, fields=None, raw=False):
+        return next(iter(self.find(collection, query, limit=1, fields=fields, raw=raw)), None)
+
+    def count(self, collection, query):
+        raise NotImplementedError()
+
+    def findOneAndUpdate(self, collection, query, changes, increments):
+        """Sets the `changes` and adds the `increments` on a matching document, and returns it updated or None."""
+        raise NotImplementedError()
+
+    def findOneAndDelete(self, collection, query, fields=None):
+        """Deletes a matching document and returns it, or None if there is none."""
+        raise NotImplementedError()
+
+    def updateMany(self, collection, query, changes, increments):
+        """Updates every matching document and returns the numbers of matched and of modified documents."""
+        raise NotImplementedError()
+
+    def deleteMany(self, collection, query):
+        """Deletes every matching document and returns their number."""
+        raise NotImplementedError()
+
+    def backfill(self, collection, field, default=None, copyFrom=None):
+        """Sets `field` on the documents that don't have it, to their value of `copyFrom` or else to `default`.
+
+        Returns the number of documents updated.
+        """
+        raise NotImplementedError()
+
+
+class MongoTodoStore(TodoStore):
+    """Stores the todos in MongoDB, through the collections of the mongoengine documents in model.py."""
+
+    supportsChangeStreams = True
+
+    def __init__(self):
+        self.reconnect()
+
+    def reconnect(self):
+        """Opens a new connection pool, dropping the current one if there is any.
+
+        The client only connects on its first operation. Pre-forking servers call this in every worker after
+        the fork, so that no socket is ever shared between processes.
+        """
+        self.close()
+        db_name = os.environ.get("DB_NAME", "todos")
+        pool = {
+            "connect": False,
+            "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+            "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+        }
+
+        if os.environ.get("FLASK_ENV", "development") != "testing":
+            connect(db_name, host="mongo", port=27017, username="admin", password="admin", authentication_source="admin", **pool)
+        else:
+            connect(db_name, host="localhost", port=27017, **pool)
+
+    def warmUp(self):
+        """Connects to the database, ensures the indexes and opens MONGO_MIN_POOL_SIZE connections up front."""
+        client = Todo._get_db().client
+        client.admin.command("ping")
+        Todo.ensure_indexes()
+        TodoTombstone.ensure_indexes()
+        ArchivedTodo.ensure_indexes()
+
+        # concurrent pings each check out their own connection, so the pool is full before the first request
+        pings = [threading.Thread(target=client.admin.command, args=("ping",))
+                 for _ in range(int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)))]
+        for ping in pings:
+            ping.start()
+        for ping in pings:
+            ping.join()
+
+    def close(self):
+        disconnect()
+        # Documents keep a handle on the collection of the client they were first used with
+        Todo._collection = None
+        TodoTombstone._collection = None
+        ArchivedTodo._collection = None
+
+    def database(self):
+        return Todo._get_db()
+
+    def drop(self):
+        self.database().drop_collection(TODOS)
+        self.database().drop_collection(TOMBSTONES)
+        self.database().drop_collection(ARCHIVE)
+
+    def insert(self, collection, documents, writeConcern=None):
+        if not documents:
+            return {}
+        target = self._collection(collection)
+        if writeConcern is not None:
+            target = target.with_options(write_concern=WriteConcern(w=writeConcern))
+        try:
+            target.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            return {writeError["index"]: writeError["errmsg"] for writeError in error.details["writeErrors"]}
+        return {}
+
+    def find(self, collection, query, sort=None, limit=0, fields=None, batchSize=None, raw=False):
+        documents = self._collection(collection, raw).find(query, projection=self._projection(fields), sort=sort, limit=limit)
+        if batchSize is not None:
+            documents = documents.batch_size(batchSize)
+        return documents
+
+    def count(self, collection, query):
+        return self._collection(collection).count_documents(query)
+
+    def findOneAndUpdate(self, collection, query, changes, increments):
+        return self._collection(collection).find_one_and_update(query, {"$set": changes, "$inc": increments},
+                                                                return_document=ReturnDocument.AFTER)
+
+    def findOneAndDelete(self, collection, query, fields=None):
+        return self._collection(collection).find_one_and_delete(query, projection=self._projection(fields))
+
+    def updateMany(self, collection, query, changes, increments):
+        result = self._collection(collection).update_many(query, {"$set": changes, "$inc": increments})
+        return result.matched_count, result.modified_count
+
+    def deleteMany(self, collection, query):
+        return self._collection(collection).delete_many(query).deleted_count
+
+    def backfill(self, collection, field, default=None, copyFrom=None):
+        target = self._collection(collection)
+        missing = {field: {"$exists": False}}
+        if copyFrom is None:
+            return target.update_many(missing, {"$set": {field: default}}).modified_count
+        # update pipelines need MongoDB 4.2, so the values are copied one batch of documents at a time
+        updated = 0
+        while True:
+            documents = list(target.find(missing, projection={copyFrom: True}, limit=BACKFILL_BATCH_SIZE))
+            if not documents:
+                return updated
+            updates = [UpdateOne(dict(missing, _id=document["_id"]), {"$set": {field: document.get(copyFrom)}})
+                       for document in documents]
+            updated += target.bulk_write(updates, ordered=False).modified_count
+
+    def _collection(self, collection, raw=False):
+        document = DOCUMENTS[collection]
+        if raw:
+            return document._get_collection().with_options(codec_options=RAW_BSON)
+        return document._get_collection()
+
+    def _projection(self, fields):
+        return {field: True for field in fields} if fields is not None else None
+
+
+def _fields(document):
+    return [document._fields[name].db_field for name in document._fields_ordered]
+
+
+def _stored(value):
+    # MongoDB keeps dates to the millisecond, and keyset cursors rely on that
+    if hasattr(value, "microsecond"):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _sortKey(value):
+    # nulls sort first, as in MongoDB, and are never compared with other values
+    return (value is not None, value)
+
+
+def _lowerBound(query, field):
+    """Returns the smallest value of `field` a document matching the query can have, or None."""
+    bounds = []
+    for key, condition in query.items():
+        if key == field:
+            if isinstance(condition, dict):
+                bounds += [condition[operator] for operator in ("$gt", "$gte") if operator in condition]
+            else:
+                bounds.append(condition)
+        elif key == "$and":
+            bounds += [bound for bound in (_lowerBound(part, field) for part in condition) if bound is not None]
+        elif key == "$or":
+            branches = [_lowerBound(branch, field) for branch in condition]
+            if branches and None not in branches:
+                bounds.append(min(branches))
+    return max(bounds) if bounds else None
+
+
+def _upperBound(query, field):
+    """Returns the largest value of `field` a document matching the query can have, or None."""
+    bounds = []
+    for key, condition in query.items():
+        if key == field:
+            if isinstance(condition, dict):
+                bounds += [condition[operator] for operator in ("$lt", "$lte") if operator in condition]
+            else:
+                bounds.append(condition)
+        elif key == "$and":
+            bounds += [bound for bound in (_upperBound(part, field) for part in condition) if bound is not None]
+        elif key == "$or":
+            branches = [_upperBound(branch, field) for branch in condition]
+            if branches and None not in branches:
+                bounds.append(max(branches))
+    return min(bounds) if bounds else None
+
+
+def _compare(operator, value, operand):
+    if operator == "$in":
+        return value in operand
+    if value is None:
+        return False
+    if operator == "$gt":
+        return value > operand
+    if operator == "$gte":
+        return value >= operand
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    raise ValueError("Unsupported query operator: {0}".format(operator))
+
+
+class MemoryCollection:
+    """The documents of one collection, each held as a tuple of its field values.
+
+    Records are found by _id in a dict, by the values of the `hashed` fields in hash indexes, and in the order
+    of the `ordered` fields in sorted lists of (value, _id) keys. A query sorted on one of the `ordered`
+    fields and _id walks the sorted index from the lower bound of the query and stops at the limit, like an
+    index scan in MongoDB.
+    """
+
+    def __init__(self, fields, hashed, ordered):
+        self.fields = fields
+        self._positions = {field: position for position, field in enumerate(fields)}
+        self._records = {}
+        self._hashed = {field: {} for field in hashed}
+        self._ordered = {field: [] for field in ordered}
+        self._lock = threading.RLock()
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            for index in self._hashed.values():
+                index.clear()
+            for index in self._ordered.values():
+                del index[:]
+
+    def insert(self, documents):
+        errors = {}
+        with self._lock:
+            for position, document in enumerate(documents):
+                if document.get("_id") is None:
+                    document["_id"] = ObjectId()
+                if document["_id"] in self._records:
+                    errors[position] = "E11000 duplicate key error dup key: {{ _id: ObjectId('{0}') }}".format(document["_id"])
+                    continue
+                unknown = set(document) - set(self.fields)
+                if unknown:
+                    errors[position] = "Unknown fields: {0}".format(", ".join(sorted(unknown)))
+                    continue
+                self._add(tuple(_stored(document.get(field)) for field in self.fields))
+        return errors
+
+    def find(self, query, sort=None, limit=0, fields=None):
+        with self._lock:
+            ids = self._select(query, sort, limit)
+        # the documents are built lazily, so that a stream holds no more than one of them at a time
+        for todoId in ids:
+            record = self._records.get(todoId)
+            if record is not None:
+                yield self._document(record, fields)
+
+    def count(self, query):
+        with self._lock:
+            return len(self._select(query, None, 0))
+
+    def update(self, query, changes, increments, many):
+        """Returns the number of matched and of modified documents and the last document as updated."""
+        matched, modified, document = 0, 0, None
+        with self._lock:
+            for todoId in self._select(query, None, 0 if many else 1):
+                record = self._records[todoId]
+                values = list(record)
+                for field, value in changes.items():
+                    values[self._positions[field]] = _stored(value)
+                for field, amount in increments.items():
+                    values[self._positions[field]] = (values[self._positions[field]] or 0) + amount
+                matched += 1
+                if tuple(values) != record:
+                    modified += 1
+                    self._remove(record)
+                    record = tuple(values)
+                    self._add(record)
+                document = self._document(record)
+        return matched, modified, document
+
+    def delete(self, query, fields=None, many=True):
+        """Returns the deleted documents."""
+        with self._lock:
+            records = [self._records[todoId] for todoId in self._select(query, None, 0 if many else 1)]
+            for record in records:
+                self._remove(record)
+        return [self._document(record, fields) for record in records]
+
+    def backfill(self, field, default=None, copyFrom=None):
+        """Returns the number of records that had no value of `field` and got one."""
+        position = self._positions[field]
+        with self._lock:
+            records = [record for record in self._records.values() if record[position] is None]
+            for record in records:
+                values = list(record)
+                values[position] = record[self._positions[copyFrom]] if copyFrom is not None else _stored(default)
+                self._remove(record)
+                self._add(tuple(values))
+        return len(records)
+
+    def _document(self, record, fields=None):
+        return {field: value for field, value in zip(self.fields, record)
+                if value is not None and (fields is None or field == "_id" or field in fields)}
+
+    def _add(self, record):
+        todoId = record[0]
+        self._records[todoId] = record
+        for field, index in self._hashed.items():
+            index.setdefault(record[self._positions[field]], set()).add(todoId)
+        for field, index in self._ordered.items():
+            bisect.insort(index, _sortKey(record[self._positions[field]]) + (todoId,))
+
+    def _remove(self, record):
+        todoId = record[0]
+        del self._records[todoId]
+        for field, index in self._hashed.items():
+            value = record[self._positions[field]]
+            index[value].discard(todoId)
+            if not index[value]:
+                del index[value]
+        for field, index in self._ordered.items():
+            key = _sortKey(record[self._positions[field]]) + (todoId,)
+            del index[bisect.bisect_left(index, key)]
+
+    def _select(self, query, sort, limit):
+        """Returns the ids of the records matching a query, sorted and limited."""
+        candidates = self._candidates(query)
+        if candidates is None and sort is not None and len(sort) == 2 and sort[1] == ("_id", 1) \
+                and sort[0][0] in self._ordered and sort[0][1] == 1:
+            return self._scan(sort[0][0], query, limit)
+
+        if candidates is None:
+            candidates = self._records.keys()
+        ids = [todoId for todoId in candidates if self._matches(self._records[todoId], query)]
+        for field, direction in reversed(sort or []):
+            position = self._positions[field]
+            ids.sort(key=lambda todoId: _sortKey(self._records[todoId][position]), reverse=direction < 0)
+        return ids[:limit] if limit else ids
+
+    def _candidates(self, query):
+        """Returns the smallest set of ids an index gives for the equality conditions of a query, or None."""
+        sets = []
+        for key, condition in query.items():
+            if key == "$and":
+                sets += [ids for ids in (self._candidates(part) for part in condition) if ids is not None]
+            elif key == "_id":
+                if isinstance(condition, dict) and list(condition) == ["$in"]:
+                    sets.append({todoId for todoId in condition["$in"] if todoId in self._records})
+                elif not isinstance(condition, dict):
+                    sets.append({condition} if condition in self._records else set())
+            elif key in self._hashed and not isinstance(condition, dict):
+                sets.append(self._hashed[key].get(condition, set()))
+        return min(sets, key=len) if sets else None
+
+    def _scan(self, field, query, limit):
+        index = self._ordered[field]
+        lower, upper = _lowerBound(query, field), _upperBound(query, field)
+        position = bisect.bisect_left(index, (True, lower)) if lower is not None else 0
+        ids = []
+        while position < len(index) and (not limit or len(ids) < limit):
+            present, value, todoId = index[position]
+            if upper is not None and present and value > upper:
+                break
+            if self._matches(self._records[todoId], query):
+                ids.append(todoId)
+            position += 1
+        return ids
+
+    def _matches(self, record, query):
+        for key, condition in query.items():
+            if key == "$and":
+                if not all(self._matches(record, part) for part in condition):
+                    return False
+            elif key == "$or":
+                if not any(self._matches(record, branch) for branch in condition):
+                    return False
+            else:
+                value = record[self._positions[key]] if key in self._positions else None
+                if isinstance(condition, dict):
+                    if not all(_compare(operator, value, operand) for operator, operand in condition.items()):
+                        return False
+                elif value != condition:
+                    return False
+        return True
+
+
+class MemoryTodoStore(TodoStore):
+    """Keeps the todos in the memory of the process, indexed on _id, createdBy, done and the timestamps."""
+
+    def __init__(self):
+        self._collections = {
+            TODOS: MemoryCollection(_fields(Todo), hashed=["createdBy", "done"], ordered=["createdAt", "updatedAt"]),
+            TOMBSTONES: MemoryCollection(_fields(TodoTombstone), hashed=["createdBy"], ordered=["deletedAt"]),
+            ARCHIVE: MemoryCollection(_fields(ArchivedTodo), hashed=["createdBy"], ordered=["createdAt"]),
+        }
+
+    def reconnect(self):
+        pass
+
+    def warmUp(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drop(self):
+        for documents in self._collections.values():
+            documents.clear()
+
+    def insert(self, collection, documents, writeConcern=None):
+        return self._collections[collection].insert(documents)
+
+    def find(self, collection, query, sort=None, limit=0, fields=None, batchSize=None, raw=False):
+        documents = self._collections[collection].find(query, sort, limit, fields)
+        if raw:
+            return (RawBSONDocument(BSON.encode(document)) for document in documents)
+        return documents
+
+    def count(self, collection, query):
+        return self._collections[collection].count(query)
+
+    def findOneAndUpdate(self, collection, query, changes, increments):
+        return self._collections[collection].update(query, changes, increments, many=False)[2]
+
+    def findOneAndDelete(self, collection, query, fields=None):
+        return next(iter(self._collections[collection].delete(query, fields, many=False)), None)
+
+    def updateMany(self, collection, query, changes, increments):
+        matched, modified, _ = self._collections[collection].update(query, changes, increments, many=True)
+        return matched, modified
+
+    def deleteMany(self, collection, query):
+        return len(self._collections[collection].delete(query))
+
+    def backfill(self, collection, field, default=None, copyFrom=None):
+        return self._collections[collection].backfill(field, default, copyFrom)
+
+
+def writeConcern(value):
+    """Parses the `w` of a write concern: a number of members, a mode like "majority", or None when empty."""
+    if not value:
+        return None
+    return int(value) if value.isdigit() else value
+
+
+def createStore():
+    """Builds the storage backend configured by the DB_BACKEND env variable."""
+    backend = os.environ.get("DB_BACKEND", "mongo")
+    if backend == "mongo":
+        return MongoTodoStore()
+    if backend == "memory":
+        return MemoryTodoStore()
+    raise ValueError("Unknown storage backend: {0}".format(backend))
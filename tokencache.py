@@ -0,0 +1,116 @@
+"""Cache of bearer tokens already verified by the security chain.
+
+Verifying a JWT means parsing it and checking its RSA signature on every secured call. Once a token has been
+accepted, the auth context the chain built for it is kept until the token expires, so repeated requests with
+the same token skip the chain altogether. The whole cache is dropped whenever the files in the keys directory
+change.
+"""
+import base64
+import binascii
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from flask import request
+from cache import LocalTodoCache
+
+
+def bearerToken():
+    """Returns the bearer token of the current request, or None."""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def tokenExpiry(token):
+    """Returns the exp claim of a JWT without verifying it, or None if the token is not a JWT with an exp."""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified tokens, keyed by the SHA-256 digest of the token."""
+
+    def __init__(self, keysDir, maxSize=10000, maxTtl=600, keysCheckInterval=5):
+        self.keysDir = keysDir
+        self.maxTtl = maxTtl
+        self.keysCheckInterval = keysCheckInterval
+        self._entries = LocalTodoCache(maxSize=maxSize, ttl=maxTtl)
+        self._lock = threading.Lock()
+        self._keys = self._keysFingerprint()
+        self._keysCheckedAt = time.monotonic()
+
+    def get(self, token):
+        """Returns the auth context of an already verified token, or None."""
+        self._checkKeys()
+        return self._entries.get(self._digest(token))
+
+    def set(self, token, auth):
+        """Remembers a verified token until its exp claim. Tokens without an exp are never cached."""
+        expiresAt = tokenExpiry(token)
+        if expiresAt is None:
+            return
+        ttl = min(expiresAt - time.time(), self.maxTtl)
+        if ttl > 0:
+            self._entries.set(self._digest(token), auth, ttl=ttl)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return self._entries.stats()
+
+    def secured(self, sec, fn):
+        """Same as `sec.secured(fn)`, but only runs the security chain for tokens that are not cached yet."""
+        def verified(*args, **kwargs):
+            token = bearerToken()
+            if token is not None:
+                self.set(token, sec.context.get_auth())
+            return fn(*args, **kwargs)
+
+        securedFn = sec.secured(verified)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            token = bearerToken()
+            auth = self.get(token) if token is not None else None
+            if auth is None:
+                return securedFn(*args, **kwargs)
+            sec.context.set_auth(auth)
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def _digest(self, token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _checkKeys(self):
+        with self._lock:
+            if time.monotonic() - self._keysCheckedAt < self.keysCheckInterval:
+                return
+            self._keysCheckedAt = time.monotonic()
+            keys = self._keysFingerprint()
+            if keys == self._keys:
+                return
+            self._keys = keys
+        self.clear()
+
+    def _keysFingerprint(self):
+        try:
+            names = sorted(os.listdir(self.keysDir))
+        except OSError:
+            return None
+        fingerprint = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.keysDir, name))
+            except OSError:
+                continue
+            fingerprint.append((name, stat.st_mtime_ns, stat.st_size))
+        return fingerprint